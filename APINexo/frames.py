@@ -0,0 +1,89 @@
+# --------------------
+# Este archivo Python contiene el buffer compartido de los streams MJPEG
+# (cámara y detecciones): cada imagen se codifica una sola vez y todos los
+# clientes reciben los mismos bytes
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+
+# Calidad JPEG de las imágenes que se retransmiten (más baja = menos datos)
+MJPEG_QUALITY = int(os.environ.get('MJPEG_QUALITY', 50))
+# Frames por segundo como máximo que se envían a cada cliente
+MJPEG_MAX_FPS = float(os.environ.get('MJPEG_MAX_FPS', 10))
+# Segundos sin imágenes nuevas tras los que se reenvía la última (así se
+# detecta si el cliente se ha ido)
+MJPEG_KEEPALIVE = float(os.environ.get('MJPEG_KEEPALIVE', 1))
+
+
+def encode_part(jpeg):
+    return (
+        b'--frame\r\n'
+        b'Content-Type: image/jpeg\r\n'
+        b'Content-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n'
+    )
+
+
+class FrameBuffer:
+    """
+    Última imagen de un topic ya codificada como parte MJPEG, con un número
+    de secuencia. Solo se decodifica y recomprime si hay alguien viendo el
+    stream, y se hace fuera del lock; los clientes esperan a que cambie la
+    secuencia y envían los bytes tal cual.
+    """
+
+    def __init__(self, quality=MJPEG_QUALITY):
+        self.quality = quality
+        self._cond = threading.Condition()
+        self._part = None
+        self._seq = 0
+        self._viewers = 0
+
+    def publish(self, data):
+        """Callback del topic con la imagen comprimida (bytes) que llega de ROS."""
+        with self._cond:
+            if self._viewers == 0:
+                return
+        frame = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        ok, jpeg = cv2.imencode('.jpg', frame, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        if not ok:
+            return
+        part = encode_part(jpeg.tobytes())
+        with self._cond:
+            self._part = part
+            self._seq += 1
+            self._cond.notify_all()
+
+    def stream(self, enabled=lambda: True):
+        """Generador para un StreamingResponse: una parte por imagen nueva."""
+        seq = 0
+        with self._cond:
+            self._viewers += 1
+        try:
+            while True:
+                if not enabled():
+                    time.sleep(0.5)
+                    continue
+
+                with self._cond:
+                    self._cond.wait_for(lambda: self._seq != seq, timeout=MJPEG_KEEPALIVE)
+                    seq, part = self._seq, self._part
+
+                if part:
+                    yield part
+                time.sleep(1 / MJPEG_MAX_FPS)
+        finally:
+            with self._cond:
+                self._viewers -= 1
+                # Sin nadie viendo deja de actualizarse: no se sirve una imagen vieja
+                if self._viewers == 0:
+                    self._part = None
+
+    def viewer_count(self):
+        with self._cond:
+            return self._viewers
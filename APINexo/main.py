@@ -3,23 +3,21 @@
 # Autor: Jaime Varas Cáceres
 # --------------------
 
-from fastapi import FastAPI, Request, Header, HTTPException, status, APIRouter
+from fastapi import FastAPI, Request, Header, HTTPException, Query, status, APIRouter
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import roslibpy
-from PIL import Image, ImageDraw
-from io import BytesIO
 
-from fastapi.responses import StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 import threading
-import cv2
-import numpy as np
 import base64
-import time
+import os
 import subprocess
 
 import camera
 from aux import move, turn
+from frames import FrameBuffer
+from map_render import map_renderer
 
 app = FastAPI()
 
@@ -53,9 +51,6 @@ class PublishRequest(BaseModel):
     message: dict
 
 
-lock = threading.Lock()
-
-
 @app.post("/publish")
 async def publish_message(data: PublishRequest):
     if not ros.is_connected:
@@ -69,81 +64,109 @@ async def publish_message(data: PublishRequest):
         return {"success": False, "error": str(e)}
 
 
-latest_map = None
+# Con MAP_UPDATES=1 el mapa se mantiene con los parches de /map_updates y
+# el /map completo solo se recibe cada MAP_FULL_THROTTLE_MS ms como mucho
+MAP_UPDATES = os.environ.get('MAP_UPDATES', '0') == '1'
+MAP_FULL_THROTTLE_MS = int(os.environ.get('MAP_FULL_THROTTLE_MS', 10000))
+
 latest_pose = None
 
 
 def subscribe_topics():
-    def map_callback(msg):
-        global latest_map
-        latest_map = msg
-
     def pose_callback(msg):
         global latest_pose
         latest_pose = msg
 
-    roslibpy.Topic(ros, '/map', 'nav_msgs/OccupancyGrid').subscribe(map_callback)
+    if MAP_UPDATES:
+        roslibpy.Topic(ros, '/map', 'nav_msgs/OccupancyGrid', throttle_rate=MAP_FULL_THROTTLE_MS,
+                       queue_length=1).subscribe(map_renderer.set_map)
+        roslibpy.Topic(ros, '/map_updates', 'map_msgs/OccupancyGridUpdate').subscribe(map_renderer.apply_update)
+    else:
+        roslibpy.Topic(ros, '/map', 'nav_msgs/OccupancyGrid').subscribe(map_renderer.set_map)
     roslibpy.Topic(ros, '/amcl_pose', 'geometry_msgs/PoseWithCovarianceStamped').subscribe(pose_callback)
 
 
 threading.Thread(target=subscribe_topics, daemon=True).start()
 
 
+@app.get("/pose")
+async def get_pose():
+    if not latest_pose:
+        raise HTTPException(status_code=503, detail="Pose not available")
+
+    pose = latest_pose['pose']['pose']
+    return {
+        "x": pose['position']['x'],
+        "y": pose['position']['y'],
+        "orientation": pose['orientation']
+    }
+
+
 @app.get("/map/snapshot")
-async def map_snapshot():
-    if not latest_map or not latest_pose:
+def map_snapshot(if_none_match: str = Header(None)):
+    pose_msg = latest_pose
+    if not map_renderer.available() or not pose_msg:
         raise HTTPException(status_code=503, detail="Map or pose not available")
 
-    width = latest_map['info']['width']
-    height = latest_map['info']['height']
-    resolution = latest_map['info']['resolution']
-    origin = latest_map['info']['origin']['position']
-    data = latest_map['data']
+    position = pose_msg['pose']['pose']['position']
+    jpeg, etag = map_renderer.snapshot(position)
+
+    # Mismo mapa y misma posición que la última vez que lo pidió el backend
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(jpeg, media_type="image/jpeg", headers={"ETag": etag})
+
 
-    # Create an RGB image
-    img = Image.new('RGB', (width, height), color='white')
+@app.get("/map/info")
+def map_info():
+    if not map_renderer.available():
+        raise HTTPException(status_code=503, detail="Map not available")
+    return map_renderer.describe()
 
-    # Convert the map data to RGB format
-    rgb_data = []
-    for val in data:
-        if val == -1:  # Unknown - typically shown as gray
-            rgb = (128, 128, 128)
-        else:
-            # Convert occupancy value (0-100) to grayscale then to RGB
-            intensity = 255 - int(val * 2.55)  # Convert 0-100 to 255-0
-            rgb = (intensity, intensity, intensity)
-        rgb_data.append(rgb)
 
-    img.putdata(rgb_data)
-    img = img.transpose(Image.FLIP_TOP_BOTTOM)
+@app.get("/map/tiles/{z}/{x}/{y}")
+def map_tile(z: int, x: int, y: int, if_none_match: str = Header(None)):
+    if not map_renderer.available():
+        raise HTTPException(status_code=503, detail="Map not available")
 
-    x = latest_pose['pose']['pose']['position']['x']
-    y = latest_pose['pose']['pose']['position']['y']
-    px = int((x - origin['x']) / resolution)
-    py = height - int((y - origin['y']) / resolution)
+    tile = map_renderer.tile(z, x, y, if_none_match)
+    if tile is None:
+        raise HTTPException(status_code=404, detail="Tile out of range")
+    png, etag = tile
+    if png is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(png, media_type="image/png", headers={"ETag": etag})
 
-    draw = ImageDraw.Draw(img)
-    draw.ellipse((px - 5, py - 5, px + 5, py + 5), fill="red")
 
-    buffer = BytesIO()
-    img.save(buffer, format='JPEG')
-    buffer.seek(0)
-    return StreamingResponse(buffer, media_type="image/jpeg")
+@app.get("/map/view")
+def map_view(
+        min_x: float = None, min_y: float = None, max_x: float = None, max_y: float = None,
+        width: int = Query(600, ge=16, le=2048), height: int = Query(400, ge=16, le=2048),
+        if_none_match: str = Header(None)
+):
+    if not map_renderer.available():
+        raise HTTPException(status_code=503, detail="Map not available")
 
+    # La posición del robot se dibuja si se conoce, pero no es obligatoria
+    pose_msg = latest_pose
+    position = pose_msg['pose']['pose']['position'] if pose_msg else None
+    view = map_renderer.view((min_x, min_y, max_x, max_y), width, height, position, if_none_match)
+    if view is None:
+        raise HTTPException(status_code=400, detail="Viewport outside the map")
+    jpeg, etag = view
+    if jpeg is None:
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(jpeg, media_type="image/jpeg", headers={"ETag": etag})
 
-latest_detections_image = None
+
+# Última imagen con las detecciones, codificada una vez para todos los clientes
+detection_frames = FrameBuffer()
 
 
 def subscribe_to_detections_image():
     def callback(message):
-        global latest_detections_image
         try:
-            img_data = base64.b64decode(message['data'])
-            np_arr = np.frombuffer(img_data, np.uint8)
-            frame = cv2.imdecode(np_arr, cv2.IMREAD_COLOR)
-
-            with lock:
-                latest_detections_image = frame
+            detection_frames.publish(base64.b64decode(message['data']))
         except Exception as e:
             print(f"Error decoding detections image: {e}")
 
@@ -157,27 +180,8 @@ stream_detections_enabled = True
 
 @app.get("/detections/stream")
 async def stream_detections():
-    def generator():
-        while True:
-            if not stream_detections_enabled:
-                time.sleep(0.5)
-                continue  # skips the stream encoding
-
-            with lock:
-                if latest_detections_image is not None:
-                    ret, jpeg = cv2.imencode('.jpg', latest_detections_image, [int(cv2.IMWRITE_JPEG_QUALITY), 50])
-                    frame = jpeg.tobytes()
-                else:
-                    frame = None
-
-            if frame:
-                yield (
-                        b'--frame\r\n'
-                        b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n'
-                )
-            time.sleep(0.1)
-
-    return StreamingResponse(generator(), media_type='multipart/x-mixed-replace; boundary=frame')
+    stream = detection_frames.stream(enabled=lambda: stream_detections_enabled)
+    return StreamingResponse(stream, media_type='multipart/x-mixed-replace; boundary=frame')
 
 
 # TODO implementar llamadas en frontend
@@ -0,0 +1,346 @@
+# --------------------
+# Este archivo Python contiene el grid del mapa (OccupancyGrid) en
+# memoria, las actualizaciones parciales de /map_updates y su
+# renderizado a imagen (completa, por teselas o de una zona) con NumPy
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import math
+import os
+import threading
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+UNKNOWN_GRAY = 128
+FREE_GRAY = 255
+
+# Lado (px) de las teselas de /map/tiles
+MAP_TILE_SIZE = int(os.environ.get('MAP_TILE_SIZE', 256))
+
+
+def _build_palette():
+    # Índice = valor de la celda como uint8 (-1 -> 255). 0..100 es la
+    # ocupación (blanco a negro); cualquier negativo es desconocido (gris)
+    values = np.arange(256)
+    palette = np.clip(255 - (values * 2.55).astype(int), 0, 255).astype(np.uint8)
+    palette[128:] = UNKNOWN_GRAY
+    return palette
+
+
+PALETTE = _build_palette()
+
+
+def map_key(msg):
+    """Identifica un mensaje de mapa por su cabecera (seq y stamp) y tamaño."""
+    header = msg.get('header') or {}
+    stamp = header.get('stamp') or {}
+    info = msg['info']
+    return (
+        header.get('seq'),
+        stamp.get('secs', stamp.get('sec')),
+        stamp.get('nsecs', stamp.get('nanosec')),
+        info['width'],
+        info['height'],
+    )
+
+
+def render_cells(cells):
+    """Grises de un bloque del grid, volteado para que la fila 0 del mapa quede abajo."""
+    return PALETTE[cells.view(np.uint8)[::-1]]
+
+
+def downsample(gray):
+    """
+    Mitad de tamaño quedándose con el píxel más oscuro de cada bloque 2x2,
+    para que las paredes de una celda no desaparezcan al alejar.
+    """
+    h, w = gray.shape
+    if h % 2 or w % 2:
+        gray = np.pad(gray, ((0, h % 2), (0, w % 2)), constant_values=FREE_GRAY)
+    return gray.reshape(gray.shape[0] // 2, 2, gray.shape[1] // 2, 2).min(axis=(1, 3))
+
+
+def _half(rect):
+    x0, y0, x1, y1 = rect
+    return x0 // 2, y0 // 2, -(-x1 // 2), -(-y1 // 2)
+
+
+def _same_geometry(a, b):
+    keys = ('width', 'height', 'resolution', 'origin')
+    return a is not None and all(a.get(k) == b.get(k) for k in keys)
+
+
+def _encode(img, fmt):
+    buffer = BytesIO()
+    img.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+
+class MapRenderer:
+    """
+    Grid del último mapa en un array int8 y su imagen renderizada. Un /map
+    completo se convierte la primera vez que hace falta; los parches de
+    /map_updates se escriben en el grid y solo se vuelve a renderizar el
+    rectángulo que ha cambiado. Un /map completo con la misma geometría se
+    compara con el grid y se trata igual que un parche de sus diferencias.
+
+    La imagen se guarda también como pirámide (cada nivel a la mitad del
+    anterior) partida en teselas con su propio número de versión: un parche
+    solo cambia el ETag de las teselas que toca.
+    """
+
+    def __init__(self, tile_size=MAP_TILE_SIZE):
+        self._lock = threading.Lock()
+        self.tile_size = tile_size
+        # Distingue los ETag de distintos arranques de la API
+        self._epoch = int(time.time())
+        self._pending = None
+        self._key = None
+        self.info = None
+        self.grid = None
+        self.version = 0
+        # Cambia cuando un mapa completo trae otro tamaño, resolución u origen
+        # (las versiones de tesela vuelven a 0)
+        self._generation = 0
+        self._levels = None
+        self._tile_versions = None
+        self._tiles = {}
+        self._base = None
+        self._dirty = []
+        self._snapshot = (None, None)
+
+    def available(self):
+        with self._lock:
+            return self._pending is not None or self.grid is not None
+
+    def set_map(self, msg):
+        """Callback de /map: se guarda sin convertir (puede llegar muy a menudo)."""
+        with self._lock:
+            if map_key(msg) != self._key:
+                self._pending = msg
+
+    def apply_update(self, msg):
+        """Callback de /map_updates: escribe el parche en el grid."""
+        with self._lock:
+            self._materialize()
+            if self.grid is None:
+                return
+            x0, y0 = msg['x'], msg['y']
+            patch = np.asarray(msg['data'], dtype=np.int8).reshape(msg['height'], msg['width'])
+            height, width = self.grid.shape
+            x1, y1 = min(x0 + msg['width'], width), min(y0 + msg['height'], height)
+            if x0 >= x1 or y0 >= y1:
+                return
+            self.grid[y0:y1, x0:x1] = patch[:y1 - y0, :x1 - x0]
+            self._dirty.append((x0, y0, x1, y1))
+            self.version += 1
+
+    def _materialize(self):
+        msg, self._pending = self._pending, None
+        if msg is None:
+            return
+        info = msg['info']
+        grid = np.asarray(msg['data'], dtype=np.int8).reshape(info['height'], info['width'])
+        self._key = map_key(msg)
+        if self._levels is not None and _same_geometry(self.info, info):
+            # Mismo mapa reenviado (o resincronización con MAP_UPDATES): solo
+            # se vuelve a renderizar la zona que ha cambiado
+            self.info = info
+            changed = self._changed_rects(grid)
+            self.grid = grid
+            if changed:
+                self._dirty.extend(changed)
+                self.version += 1
+            return
+        self.grid = grid
+        self.info = info
+        self._levels = None
+        self._dirty = []
+        self.version += 1
+        self._generation += 1
+
+    def _changed_rects(self, grid):
+        """
+        Rectángulos (x0, y0, x1, y1) del grid con las celdas distintas en
+        `grid`, uno por tesela del nivel 0 para que solo cambie el ETag de
+        las teselas tocadas.
+        """
+        rows, cols = np.nonzero(self.grid != grid)
+        if len(rows) == 0:
+            return []
+        size = self.tile_size
+        # Las teselas se cuentan en la imagen, con las filas volteadas
+        tile_rows = (grid.shape[0] - 1 - rows) // size
+        keys = tile_rows * (-(-grid.shape[1] // size)) + cols // size
+        order = np.argsort(keys, kind='stable')
+        keys, rows, cols = keys[order], rows[order], cols[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        return list(zip(
+            np.minimum.reduceat(cols, starts).tolist(),
+            np.minimum.reduceat(rows, starts).tolist(),
+            (np.maximum.reduceat(cols, starts) + 1).tolist(),
+            (np.maximum.reduceat(rows, starts) + 1).tolist(),
+        ))
+
+    def _sync(self):
+        """Pone al día imagen y pirámide, rehaciendo solo las zonas modificadas."""
+        self._materialize()
+        if self._levels is None:
+            self._build()
+        height = self.grid.shape[0]
+        for x0, y0, x1, y1 in self._dirty:
+            # En la imagen la fila 0 es la de arriba (y máxima del mapa)
+            rect = (x0, height - y1, x1, height - y0)
+            self._levels[0][rect[1]:rect[3], rect[0]:rect[2]] = render_cells(self.grid[y0:y1, x0:x1])
+            patch = Image.fromarray(np.ascontiguousarray(self._levels[0][rect[1]:rect[3], rect[0]:rect[2]]), 'L')
+            self._base.paste(patch.convert('RGB'), rect[:2])
+            self._touch(0, rect)
+            for level in range(1, len(self._levels)):
+                rect = _half(rect)
+                previous = self._levels[level - 1]
+                self._levels[level][rect[1]:rect[3], rect[0]:rect[2]] = downsample(
+                    previous[2 * rect[1]:2 * rect[3], 2 * rect[0]:2 * rect[2]])
+                self._touch(level, rect)
+        self._dirty = []
+
+    def _build(self):
+        gray = render_cells(self.grid)
+        self._levels = [gray]
+        while max(self._levels[-1].shape) > self.tile_size:
+            self._levels.append(downsample(self._levels[-1]))
+        self._tile_versions = [
+            np.zeros((-(-level.shape[0] // self.tile_size), -(-level.shape[1] // self.tile_size)), dtype=np.int64)
+            for level in self._levels
+        ]
+        self._tiles = {}
+        self._base = Image.fromarray(gray, 'L').convert('RGB')
+
+    def _touch(self, level, rect):
+        x0, y0, x1, y1 = rect
+        size = self.tile_size
+        self._tile_versions[level][y0 // size:-(-y1 // size), x0 // size:-(-x1 // size)] += 1
+
+    def _pixel(self, pose):
+        info = self.info
+        origin = info['origin']['position']
+        px = (pose['x'] - origin['x']) / info['resolution']
+        py = info['height'] - (pose['y'] - origin['y']) / info['resolution']
+        return px, py
+
+    def snapshot(self, pose):
+        """(JPEG, ETag) del mapa con la posición del robot."""
+        with self._lock:
+            self._sync()
+            px, py = (int(v) for v in self._pixel(pose))
+            etag = f'"{self._epoch}-{self.version}-{px}-{py}"'
+            if self._snapshot[0] == etag:
+                return self._snapshot[1], etag
+            img = self._base.copy()
+
+        draw = ImageDraw.Draw(img)
+        draw.ellipse((px - 5, py - 5, px + 5, py + 5), fill="red")
+        jpeg = _encode(img, 'JPEG')
+
+        with self._lock:
+            self._snapshot = (etag, jpeg)
+        return jpeg, etag
+
+    def describe(self):
+        """Datos que necesita un cliente para pedir teselas y situarlas en el mapa."""
+        with self._lock:
+            self._sync()
+            origin = self.info['origin']['position']
+            return {
+                "width": self.info['width'],
+                "height": self.info['height'],
+                "resolution": self.info['resolution'],
+                "origin": {"x": origin['x'], "y": origin['y']},
+                "tile_size": self.tile_size,
+                "max_zoom": len(self._levels) - 1,
+            }
+
+    def tile(self, z, x, y, if_none_match=None):
+        """
+        (PNG, ETag) de la tesela x, y del zoom z (0 = el mapa entero en una
+        tesela; max_zoom = resolución nativa; y = 0 arriba). Si el cliente ya tiene esa
+        versión devuelve (None, ETag); si no existe, None.
+        """
+        with self._lock:
+            self._sync()
+            level = len(self._levels) - 1 - z
+            if not 0 <= level < len(self._levels):
+                return None
+            versions = self._tile_versions[level]
+            if not (0 <= y < versions.shape[0] and 0 <= x < versions.shape[1]):
+                return None
+            etag = f'"{self._epoch}-{self._generation}-{versions[y, x]}"'
+            if if_none_match == etag:
+                return None, etag
+            cached = self._tiles.get((z, x, y))
+            if cached is not None and cached[0] == etag:
+                return cached[1], etag
+            size = self.tile_size
+            block = self._levels[level][y * size:(y + 1) * size, x * size:(x + 1) * size]
+            # Las teselas del borde se completan con gris de desconocido
+            tile = np.full((size, size), UNKNOWN_GRAY, dtype=np.uint8)
+            tile[:block.shape[0], :block.shape[1]] = block
+
+        png = _encode(Image.fromarray(tile, 'L'), 'PNG')
+        with self._lock:
+            self._tiles[(z, x, y)] = (etag, png)
+        return png, etag
+
+    def view(self, bounds, width, height, pose=None, if_none_match=None):
+        """
+        (JPEG, ETag) de la zona `bounds` (min_x, min_y, max_x, max_y en metros,
+        None = todo el mapa) escalada para caber en width x height. Se recorta
+        del nivel de la pirámide más pequeño que aún da esa resolución. El
+        ETag solo cambia si cambian las teselas de la zona o la posición del
+        robot dentro de la imagen. Devuelve None si la zona queda fuera del mapa.
+        """
+        with self._lock:
+            self._sync()
+            map_h, map_w = self._levels[0].shape
+            resolution = self.info['resolution']
+            origin = self.info['origin']['position']
+            min_x, min_y, max_x, max_y = bounds
+            x0 = 0 if min_x is None else max(0, math.floor((min_x - origin['x']) / resolution))
+            x1 = map_w if max_x is None else min(map_w, math.ceil((max_x - origin['x']) / resolution))
+            y0 = 0 if max_y is None else max(0, map_h - math.ceil((max_y - origin['y']) / resolution))
+            y1 = map_h if min_y is None else min(map_h, map_h - math.floor((min_y - origin['y']) / resolution))
+            if x0 >= x1 or y0 >= y1:
+                return None
+
+            scale = min(width / (x1 - x0), height / (y1 - y0))
+            level = 0 if scale >= 1 else min(int(math.log2(1 / scale)), len(self._levels) - 1)
+            rect = (x0, y0, x1, y1)
+            for _ in range(level):
+                rect = _half(rect)
+            size = (max(1, round((x1 - x0) * scale)), max(1, round((y1 - y0) * scale)))
+
+            marker = None
+            if pose is not None:
+                px, py = self._pixel(pose)
+                marker = (int((px - x0) * scale), int((py - y0) * scale))
+            tiles = self._tile_versions[level][
+                rect[1] // self.tile_size:-(-rect[3] // self.tile_size),
+                rect[0] // self.tile_size:-(-rect[2] // self.tile_size)]
+            # Las versiones solo crecen: la suma cambia si cambia cualquiera
+            etag = (f'"{self._epoch}-{self._generation}-{int(tiles.sum())}-'
+                    f'{x0}.{y0}.{x1}.{y1}-{size[0]}x{size[1]}-{marker}"').replace(" ", "")
+            if if_none_match == etag:
+                return None, etag
+            crop = self._levels[level][rect[1]:rect[3], rect[0]:rect[2]].copy()
+
+        resample = Image.NEAREST if scale >= 1 else Image.BOX
+        img = Image.fromarray(crop, 'L').resize(size, resample).convert('RGB')
+        if marker is not None:
+            mx, my = marker
+            ImageDraw.Draw(img).ellipse((mx - 5, my - 5, mx + 5, my + 5), fill="red")
+        return _encode(img, 'JPEG'), etag
+
+
+map_renderer = MapRenderer()
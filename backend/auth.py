@@ -3,13 +3,20 @@
 # Autor: Jaime Varas Cáceres
 # --------------------
 
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from types import MappingProxyType
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt, JWTError
 from passlib.context import CryptContext
-from sqlalchemy.orm import Session
-from database import SessionLocal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import make_transient_to_detached
+from cache import CommitTracker, TTLCache, flushed
+from database import AsyncSessionLocal
 from models import User
 import os
 from dotenv import load_dotenv
@@ -21,23 +28,126 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# Coste de bcrypt (2^rounds iteraciones). Los hashes con otro coste se
+# rehacen al hacer login (ver authenticate_user)
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+pwd_context = CryptContext(
+    schemes=["bcrypt"], deprecated="auto",
+    bcrypt__default_rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS, bcrypt__max_rounds=BCRYPT_ROUNDS
+)
 
-def get_db():
-    db = SessionLocal()
-    try:
+# Hilos dedicados a bcrypt y hashes que pueden esperar turno; por encima se
+# responde 503 en lugar de encolar
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 1))
+PASSWORD_HASH_QUEUE = int(os.environ.get('PASSWORD_HASH_QUEUE', 4 * PASSWORD_HASH_WORKERS))
+
+# Usuarios autenticados que se guardan en memoria y durante cuántos segundos
+PRINCIPAL_CACHE_SIZE = int(os.environ.get('PRINCIPAL_CACHE_SIZE', 1024))
+PRINCIPAL_CACHE_TTL = float(os.environ.get('PRINCIPAL_CACHE_TTL', 300))
+
+
+class PrincipalCache:
+    """
+    Caché LRU con caducidad de los usuarios por el "sub" del token, para no
+    consultar la tabla users en cada petición autenticada. Se guarda una
+    copia inmutable de sus columnas y cada petición recibe su propio User
+    construido a partir de ella. Las entradas de un usuario se descartan al
+    confirmar un cambio o un borrado suyo.
+    """
+
+    def __init__(self, maxsize=PRINCIPAL_CACHE_SIZE, ttl=PRINCIPAL_CACHE_TTL):
+        self._cache = TTLCache(maxsize, ttl)
+
+    def get(self, username):
+        snapshot = self._cache.get(username)
+        return None if snapshot is None else _user_from(snapshot)
+
+    def generation(self):
+        return self._cache.generation()
+
+    def put(self, username, user, generation):
+        self._cache.put(username, _snapshot(user), generation)
+
+    def invalidate(self, user_id=None):
+        if user_id is None:
+            self._cache.invalidate()
+        else:
+            self._cache.invalidate_where(lambda snapshot: snapshot["id"] == user_id)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def _snapshot(user):
+    return MappingProxyType({c.key: getattr(user, c.key) for c in User.__table__.columns})
+
+
+def _user_from(snapshot):
+    # Separado de cualquier sesión, como el que se lee de la BD
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return user
+
+
+principal_cache = PrincipalCache()
+
+
+def _invalidate_users(user_ids):
+    for user_id in set(user_ids):
+        principal_cache.invalidate(user_id)
+
+
+user_changes = CommitTracker(
+    "user_changes", _invalidate_users, lambda session: (user.id for user in flushed(session, User))
+)
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+class PasswordHasher:
+    """
+    Ejecuta bcrypt en un pool de hilos propio, para que una ráfaga de logins
+    no ocupe el threadpool compartido con el resto de endpoints. Admite como
+    mucho `workers + queue` operaciones a la vez; el resto se rechaza al
+    momento con un 503.
+    """
+
+    def __init__(self, workers=PASSWORD_HASH_WORKERS, queue=PASSWORD_HASH_QUEUE):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._slots = threading.BoundedSemaphore(workers + queue)
+        self._lock = threading.Lock()
+        self.accepted = self.rejected = 0
+
+    async def run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Servidor ocupado, inténtalo de nuevo",
+                headers={"Retry-After": "1"}
+            )
+        with self._lock:
+            self.accepted += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self._slots.release()
 
+    def stats(self):
+        with self._lock:
+            return {"accepted": self.accepted, "rejected": self.rejected}
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+
+password_hasher = PasswordHasher()
+
+
+async def hash_password_async(password: str) -> str:
+    return await password_hasher.run(pwd_context.hash, password)
 
 
 def create_access_token(data: dict):
@@ -47,10 +157,32 @@ def create_access_token(data: dict):
     return jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
 
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = db.query(User).filter(User.username == username).first()
-    if not user or not verify_password(password, user.hashed_password):
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = await db.scalar(select(User).where(User.username == username))
+    if not user:
+        return None
+    valid, new_hash = await password_hasher.run(pwd_context.verify_and_update, password, user.hashed_password)
+    if not valid:
         return None
+    if new_hash:
+        # Hash con un coste distinto de BCRYPT_ROUNDS: se guarda el nuevo
+        user.hashed_password = new_hash
+        await db.commit()
+    return user
+
+
+async def get_user_by_username(db: AsyncSession, username: str):
+    """Usuario del "sub" de un token, de la caché si está."""
+    user = principal_cache.get(username)
+    if user is not None:
+        return user
+
+    generation = principal_cache.generation()
+    user = await db.scalar(select(User).where(User.username == username))
+    if user is not None:
+        # Se guarda separado de la sesión: solo se usan sus columnas
+        db.expunge(user)
+        principal_cache.put(username, user, generation)
     return user
 
 
@@ -62,9 +194,9 @@ def verify_token(token: str = Depends(oauth2_scheme)):
         raise HTTPException(status_code=401, detail="Invalid token")
 
 
-def get_current_user(
+async def get_current_user(
         token: str = Depends(oauth2_scheme),
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -79,15 +211,15 @@ def get_current_user(
     except JWTError:
         raise credentials_exception
 
-    user = db.query(User).filter(User.username == username).first()
+    user = await get_user_by_username(db, username)
     if user is None:
         raise credentials_exception
     return user
 
 
-def get_current_user_from_request(
+async def get_current_user_from_request(
         request: Request,
-        db: Session = Depends(get_db)
+        db: AsyncSession = Depends(get_async_db)
 ) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -106,7 +238,7 @@ def get_current_user_from_request(
     except JWTError:
         raise credentials_exception
 
-    user = db.query(User).filter(User.username == username).first()
+    user = await get_user_by_username(db, username)
     if user is None:
         raise credentials_exception
 
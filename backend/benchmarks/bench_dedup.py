@@ -0,0 +1,57 @@
+# --------------------
+# Benchmark del descarte de duplicados: bucle por fila con is_close
+# frente al motor vectorizado de dedup.py
+# Uso (desde /backend): python -m benchmarks.bench_dedup
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import os
+import random
+import time
+
+import numpy as np
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")  # dedup.py importa los modelos
+
+from dedup import duplicate_mask  # noqa: E402
+from spatial import is_close  # noqa: E402
+
+BATCH = 50
+REPEAT = 5
+DENSITY = 0.1  # detecciones por m² del mapa simulado
+
+
+def per_row(stored, incoming):
+    return [any(is_close(d, p) for d in stored) for p in incoming]
+
+
+def vectorized(stored, incoming):
+    return duplicate_mask(stored, incoming)
+
+
+def best_of(fn, *args):
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    print(f"{'stored':>8} {'per-row (ms)':>14} {'numpy (ms)':>12} {'speedup':>8}")
+    for n in (1_000, 10_000, 100_000):
+        side = (n / DENSITY) ** 0.5
+        stored = [{"x": random.uniform(0, side), "y": random.uniform(0, side), "z": 0} for _ in range(n)]
+        incoming = [{"x": random.uniform(0, side), "y": random.uniform(0, side), "z": 0} for _ in range(BATCH)]
+        stored_np = np.array(sorted([d["x"], d["y"]] for d in stored))
+        incoming_np = np.array([[p["x"], p["y"]] for p in incoming])
+
+        assert per_row(stored, incoming) == vectorized(stored_np, incoming_np).tolist()
+        slow = best_of(per_row, stored, incoming)
+        fast = best_of(vectorized, stored_np, incoming_np)
+        print(f"{n:>8} {slow * 1000:>14.2f} {fast * 1000:>12.2f} {slow / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
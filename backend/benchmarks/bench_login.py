@@ -0,0 +1,58 @@
+# --------------------
+# Benchmark de los logins por segundo que aguanta el pool de bcrypt
+# de auth.py con cada coste (BCRYPT_ROUNDS)
+# Uso (desde /backend): python -m benchmarks.bench_login
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import asyncio
+import os
+import time
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")  # auth.py importa los modelos
+
+from auth import PasswordHasher, PASSWORD_HASH_WORKERS  # noqa: E402
+
+LOGINS = 64
+ROUNDS = (8, 10, 12)
+
+
+async def burst(hasher, context, hashed):
+    """Lanza LOGINS verificaciones a la vez; devuelve (segundos, aceptadas, rechazadas)."""
+    async def login():
+        try:
+            valid, _ = await hasher.run(context.verify_and_update, "password", hashed)
+            return valid
+        except HTTPException:
+            return None
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(login() for _ in range(LOGINS)))
+    elapsed = time.perf_counter() - start
+    return elapsed, sum(r is True for r in results), sum(r is None for r in results)
+
+
+async def main():
+    print(f"workers={PASSWORD_HASH_WORKERS}, {LOGINS} logins simultáneos")
+    print(f"{'rounds':>6} {'ms/hash':>8} {'logins/s':>9} {'logins/s (cola 8)':>18} {'rechazados':>11}")
+    for rounds in ROUNDS:
+        context = CryptContext(schemes=["bcrypt"], bcrypt__default_rounds=rounds)
+        hashed = context.hash("password")
+
+        start = time.perf_counter()
+        context.verify("password", hashed)
+        single = time.perf_counter() - start
+
+        # Sin límite práctico de cola: todos esperan turno
+        elapsed, ok, _ = await burst(PasswordHasher(queue=LOGINS), context, hashed)
+        # Con cola corta: los que no caben se rechazan al momento
+        bounded_elapsed, bounded_ok, rejected = await burst(PasswordHasher(queue=8), context, hashed)
+        print(f"{rounds:>6} {single * 1000:>8.1f} {ok / elapsed:>9.1f} "
+              f"{bounded_ok / bounded_elapsed:>18.1f} {rejected:>11}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
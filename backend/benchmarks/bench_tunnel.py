@@ -0,0 +1,91 @@
+# --------------------
+# Benchmark de la latencia de los comandos al túnel: requests.post sin
+# sesión (conexión nueva por comando) frente al cliente compartido de tunnel.py
+# Uso (desde /backend): python -m benchmarks.bench_tunnel
+# Con BENCH_TUNNEL_URL se mide contra un túnel real; si no, contra un
+# servidor local que responde al instante
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import asyncio
+import os
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+COMMANDS = 200
+PATH = "/move-forward"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    # Cabeceras y cuerpo en un solo envío (si no, el ACK retardado añade ~40 ms)
+    wbufsize = 64 * 1024
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def log_message(self, *args):
+        pass
+
+
+def local_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def report(name, samples):
+    samples = sorted(samples)
+    p95 = samples[int(len(samples) * 0.95) - 1]
+    print(f"{name:<28} {statistics.mean(samples) * 1000:>9.2f} {statistics.median(samples) * 1000:>9.2f} "
+          f"{p95 * 1000:>9.2f}")
+
+
+def bench_requests(url):
+    headers = {'X-Tunnel-Authorization': 'tunnel ' + os.environ['TUNNEL_AUTH_TOKEN']}
+    samples = []
+    for _ in range(COMMANDS):
+        start = time.perf_counter()
+        requests.post(url + PATH, headers=headers, timeout=5).raise_for_status()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+async def bench_shared_client():
+    from tunnel import tunnel_client, close_tunnel_client
+    samples = []
+    for _ in range(COMMANDS):
+        start = time.perf_counter()
+        (await tunnel_client().post(PATH)).raise_for_status()
+        samples.append(time.perf_counter() - start)
+    await close_tunnel_client()
+    return samples
+
+
+def main():
+    url = os.environ.get("BENCH_TUNNEL_URL")
+    server = None
+    if url is None:
+        server, url = local_server()
+    # tunnel.py los lee al importarse
+    os.environ["TUNNEL_URL"] = url
+    os.environ.setdefault("TUNNEL_AUTH_TOKEN", "bench")
+
+    print(f"{COMMANDS} comandos POST {PATH} contra {url}")
+    print(f"{'':<28} {'media ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    report("requests.post (sin sesión)", bench_requests(url))
+    report("httpx.AsyncClient compartido", asyncio.run(bench_shared_client()))
+    if server:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# --------------------
+# Este archivo Python contiene el hub en memoria que reparte
+# eventos entre los clientes suscritos (SSE)
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import asyncio
+import threading
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+
+class BroadcastHub:
+    """
+    Reparte cada evento publicado a las colas de los suscriptores de un
+    canal. Se puede publicar desde cualquier hilo (los endpoints síncronos
+    corren en el threadpool). Si un cliente lento llena su cola, se descarta
+    su evento más antiguo en lugar de acumular memoria.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        subscriber = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers[channel].add(subscriber)
+        try:
+            yield queue
+        finally:
+            with self._lock:
+                self._subscribers[channel].discard(subscriber)
+                if not self._subscribers[channel]:
+                    del self._subscribers[channel]
+
+    @staticmethod
+    def _deliver(queue, event):
+        if queue.full():
+            queue.get_nowait()
+        queue.put_nowait(event)
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(self._deliver, queue, event)
+            except RuntimeError:
+                pass  # loop ya cerrado; el suscriptor se está yendo
+
+    def subscriber_count(self, channel):
+        with self._lock:
+            return len(self._subscribers.get(channel, ()))
+
+
+# Canal por robot con las detecciones temporales aceptadas
+temp_detections_hub = BroadcastHub()
@@ -0,0 +1,110 @@
+# --------------------
+# Este archivo Python contiene las piezas comunes de las cachés en
+# memoria: un LRU con caducidad y el registro de cambios de una sesión
+# que se aplican a la caché al confirmar
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+
+class TTLCache:
+    """
+    Caché LRU con caducidad, segura entre hilos. Cada invalidación cambia la
+    generación: quien lee de la BD la toma antes (generation()) y put() no
+    guarda el resultado si entretanto se confirmó algún cambio. Los valores
+    no pueden ser None (get() devuelve None cuando no hay entrada).
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._generation = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self._generation or self.maxsize <= 0:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Descarta las entradas cuyo valor cumple `predicate`."""
+        with self._lock:
+            self._generation += 1
+            self._entries = OrderedDict((k, v) for k, v in self._entries.items() if not predicate(v[1]))
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
+class CommitTracker:
+    """
+    Acumula en session.info[name] los cambios de una transacción, tanto los
+    que se registran a mano con add() como los que `collect(session)` saca
+    de cada flush del ORM. Al confirmar se pasan todos a `apply(items)`; si
+    se deshace la transacción se descartan.
+    """
+
+    def __init__(self, name, apply, collect=None):
+        self.name = name
+        self._apply = apply
+        self._collect = collect
+        if collect is not None:
+            event.listen(Session, "after_flush", self._after_flush)
+        event.listen(Session, "after_commit", self._after_commit)
+        event.listen(Session, "after_rollback", self._after_rollback)
+
+    def add(self, session, *items):
+        session.info.setdefault(self.name, []).extend(items)
+
+    def _after_flush(self, session, flush_context):
+        self.add(session, *self._collect(session))
+
+    def _after_commit(self, session):
+        items = session.info.pop(self.name, None)
+        if items:
+            self._apply(items)
+
+    def _after_rollback(self, session):
+        session.info.pop(self.name, None)
+
+
+def flushed(session, model):
+    """Objetos de `model` creados, modificados o borrados en el flush."""
+    return [obj for obj in (*session.new, *session.dirty, *session.deleted) if isinstance(obj, model)]
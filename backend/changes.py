@@ -0,0 +1,55 @@
+# --------------------
+# Este archivo Python registra los borrados de detecciones
+# para la sincronización incremental de los clientes
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, insert, select, literal
+from sqlalchemy.orm import Session
+
+from models import Detection, TempDetection, DetectionTombstone
+
+# Margen con el que se devuelve el cursor de GET /detections/changes. Las
+# marcas de tiempo se ponen al hacer el INSERT/UPDATE (no al hacer commit) y
+# con el reloj de cada worker: una fila marcada antes del cursor puede
+# hacerse visible después. Tiene que cubrir la transacción más larga más el
+# desfase entre relojes.
+SYNC_SAFETY_WINDOW = timedelta(seconds=float(os.environ.get('SYNC_SAFETY_WINDOW_SECONDS', 60)))
+# Las lápidas más antiguas que esto se borran (ver maintenance.py): un
+# cliente con un cursor anterior recibe la lista completa con "reset"
+TOMBSTONE_TTL = timedelta(days=float(os.environ.get('TOMBSTONE_TTL_DAYS', 30)))
+
+
+def sync_cursor():
+    """
+    Cursor para la próxima consulta incremental. Queda SYNC_SAFETY_WINDOW
+    por detrás, así que las respuestas se solapan: los clientes deben aplicar
+    los cambios por id (upsert/borrado idempotentes).
+    """
+    return datetime.utcnow() - SYNC_SAFETY_WINDOW
+
+
+def tombstones_for(model, *where):
+    """
+    INSERT ... SELECT con las lápidas de las filas de `model` que cumplen
+    `where`. Hay que ejecutarlo antes de un DELETE masivo, que no pasa por
+    los eventos del ORM.
+    """
+    rows = select(
+        literal(model.__tablename__), model.id, model.robot_id, literal(datetime.utcnow())
+    ).where(*where)
+    return insert(DetectionTombstone).from_select(["source_table", "detection_id", "robot_id", "deleted_at"], rows)
+
+
+@event.listens_for(Session, "before_flush")
+def _add_tombstones(session, flush_context, instances):
+    for obj in session.deleted:
+        if isinstance(obj, (Detection, TempDetection)):
+            session.add(DetectionTombstone(
+                source_table=obj.__tablename__,
+                detection_id=obj.id,
+                robot_id=obj.robot_id
+            ))
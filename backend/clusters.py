@@ -0,0 +1,243 @@
+# --------------------
+# Este archivo Python contiene el agrupamiento incremental de las
+# detecciones temporales: cada fila de temp_detections es un cluster
+# con su centroide, sus observaciones (hits) y su confianza acumulada
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import itertools
+import math
+import os
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import select, or_, and_
+
+from cache import CommitTracker, flushed
+from models import TempDetection
+from spatial import DEDUP_RADIUS, CELL_SIZE, cell_of
+
+# Un cluster pasa solo a detections cuando reúne estas observaciones y esta
+# confianza acumulada (CLUSTER_PROMOTE_HITS=0 lo desactiva)
+CLUSTER_PROMOTE_HITS = int(os.environ.get('CLUSTER_PROMOTE_HITS', 5))
+CLUSTER_PROMOTE_CONFIDENCE = int(os.environ.get('CLUSTER_PROMOTE_CONFIDENCE', 90))
+# Segundos que se usan los clusters cacheados de una clave antes de volver a
+# leerlos (así se ven los que han abierto otros procesos)
+CLUSTER_CACHE_TTL = float(os.environ.get('CLUSTER_CACHE_TTL', 60))
+
+
+def combine_confidence(a, b):
+    """Confianza (0-100) de dos observaciones independientes del mismo objeto (noisy-OR)."""
+    return round(100 - (100 - (a or 0)) * (100 - (b or 0)) / 100)
+
+
+def should_promote(cluster):
+    return (
+        CLUSTER_PROMOTE_HITS > 0
+        and cluster["hits"] >= CLUSTER_PROMOTE_HITS
+        and cluster["confidence"] >= CLUSTER_PROMOTE_CONFIDENCE
+    )
+
+
+class ClusterGrid:
+    """Hash espacial de clusters: celda de la rejilla -> {id: cluster}."""
+
+    def __init__(self):
+        self.cells = defaultdict(dict)
+        self.clusters = {}
+
+    def put(self, cluster):
+        """Añade el cluster o lo mueve a su celda actual si ya estaba."""
+        self.discard(cluster["id"])
+        self.clusters[cluster["id"]] = cluster
+        self.cells[cell_of(cluster["x"], cluster["y"])][cluster["id"]] = cluster
+
+    def discard(self, cluster_id):
+        cluster = self.clusters.pop(cluster_id, None)
+        if cluster is not None:
+            cell = cell_of(cluster["x"], cluster["y"])
+            del self.cells[cell][cluster_id]
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def around(self, x, y, radius=DEDUP_RADIUS):
+        cx, cy = cell_of(x, y)
+        reach = math.ceil(radius / CELL_SIZE)
+        for i in range(cx - reach, cx + reach + 1):
+            for j in range(cy - reach, cy + reach + 1):
+                yield from self.cells.get((i, j), {}).values()
+
+
+class ClusterBatch:
+    """
+    Cambios de un lote sobre los clusters de una clave (robot_id, label).
+    Trabaja con copias: la caché solo se toca al confirmar la transacción.
+    Los clusters nuevos llevan ids negativos hasta que se insertan. En
+    `deltas` se acumula lo que el lote añade a cada cluster (observaciones,
+    sumas de coordenadas y probabilidad de fallo de todas ellas), para
+    aplicarlo en relativo sobre lo que haya en la BD.
+    """
+
+    _new_ids = itertools.count(-1, -1)
+
+    def __init__(self, base, radius=DEDUP_RADIUS):
+        self.base = base
+        self.radius = radius
+        self.local = ClusterGrid()
+        self.touched = {}
+        self.deltas = {}
+
+    def nearest(self, x, y):
+        best, best_distance = None, self.radius
+        for cluster in (*self.base(x, y), *self.local.around(x, y, self.radius)):
+            if cluster["id"] in self.touched and cluster is not self.touched[cluster["id"]]:
+                continue  # versión anterior de un cluster ya modificado en el lote
+            distance = math.hypot(cluster["x"] - x, cluster["y"] - y)
+            if distance < best_distance:
+                best, best_distance = cluster, distance
+        return best
+
+    def observe(self, x, y, z, confidence, nav):
+        """Añade una observación al cluster más cercano, o abre uno nuevo en (x, y)."""
+        cluster = self.nearest(x, y)
+        if cluster is None:
+            cluster = {"id": next(self._new_ids), "x": x, "y": y, "z": z, "nav": nav, "hits": 0, "confidence": 0}
+        elif cluster["id"] not in self.touched:
+            cluster = dict(cluster)
+        # Se saca de la rejilla antes de mover el centroide
+        self.local.discard(cluster["id"])
+
+        hits = cluster["hits"]
+        cluster["x"] = (cluster["x"] * hits + x) / (hits + 1)
+        cluster["y"] = (cluster["y"] * hits + y) / (hits + 1)
+        cluster["z"] = ((cluster["z"] or 0) * hits + (z or 0)) / (hits + 1)
+        cluster["hits"] = hits + 1
+        cluster["confidence"] = combine_confidence(cluster["confidence"], confidence)
+
+        delta = self.deltas.setdefault(cluster["id"], {"n": 0, "x": 0.0, "y": 0.0, "z": 0.0, "miss": 1.0})
+        delta["n"] += 1
+        delta["x"] += x
+        delta["y"] += y
+        delta["z"] += z or 0
+        delta["miss"] *= (100 - (confidence or 0)) / 100
+
+        self.touched[cluster["id"]] = cluster
+        self.local.put(cluster)
+        return cluster
+
+
+class ClusterIndex:
+    """
+    Caché por (robot_id, label) del hash espacial de los clusters temporales.
+    Cada clave se carga de la BD y se mantiene con los cambios confirmados
+    (ver los listeners de abajo) durante `ttl` segundos. Solo sirve para
+    elegir a qué cluster se une una observación: los valores se actualizan
+    en relativo en la BD (ver ingest.cluster_temp_markers).
+    """
+
+    def __init__(self, radius=DEDUP_RADIUS, ttl=CLUSTER_CACHE_TTL):
+        self.radius = radius
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._grids = {}
+        self._loaded_at = {}
+        self._generation = 0
+
+    def _load(self, db, keys):
+        now = time.monotonic()
+        with self._lock:
+            missing = [k for k in keys if k not in self._grids or now - self._loaded_at[k] > self.ttl]
+            generation = self._generation
+        if not missing:
+            return {}
+
+        grids = {k: ClusterGrid() for k in missing}
+        rows = db.execute(
+            select(TempDetection.id, TempDetection.robot_id, TempDetection.label, TempDetection.obj_x,
+                   TempDetection.obj_y, TempDetection.position_obj, TempDetection.position_nav,
+                   TempDetection.hits, TempDetection.confidence)
+            .where(
+                or_(*[and_(TempDetection.robot_id == robot_id, TempDetection.label == label)
+                      for robot_id, label in missing]),
+                TempDetection.obj_x.is_not(None)
+            )
+        )
+        for row in rows:
+            grids[(row.robot_id, row.label)].put({
+                "id": row.id, "x": row.obj_x, "y": row.obj_y, "z": (row.position_obj or {}).get("z"),
+                "nav": row.position_nav, "hits": row.hits or 1, "confidence": row.confidence or 0,
+            })
+
+        with self._lock:
+            # Si entretanto se confirmó algún cambio, lo leído puede no incluirlo
+            if generation == self._generation:
+                self._grids.update(grids)
+                self._loaded_at.update(dict.fromkeys(grids, now))
+        return grids
+
+    def batch(self, db, key):
+        """ClusterBatch de la clave, leyendo los clusters de la caché."""
+        loaded = self._load(db, [key]).get(key)
+
+        def around(x, y):
+            with self._lock:
+                grid = self._grids.get(key, loaded)
+                return [dict(c) for c in grid.around(x, y, self.radius)] if grid else []
+
+        return ClusterBatch(around, self.radius)
+
+    def put(self, key, cluster):
+        with self._lock:
+            self._generation += 1
+            if key in self._grids:
+                self._grids[key].put(cluster)
+
+    def remove(self, key, cluster_id):
+        with self._lock:
+            self._generation += 1
+            if key in self._grids:
+                self._grids[key].discard(cluster_id)
+
+    def invalidate(self, key=None):
+        with self._lock:
+            self._generation += 1
+            if key is None:
+                self._grids.clear()
+                self._loaded_at.clear()
+            else:
+                self._grids.pop(key, None)
+                self._loaded_at.pop(key, None)
+
+
+cluster_index = ClusterIndex()
+
+
+def _apply_cluster_changes(changes):
+    for action, *args in changes:
+        getattr(cluster_index, action)(*args)
+
+
+cluster_changes = CommitTracker(
+    "cluster_changes", _apply_cluster_changes,
+    lambda session: (("invalidate", (obj.robot_id, obj.label)) for obj in flushed(session, TempDetection))
+)
+
+
+def note_updated(session, robot_id, label, cluster):
+    """Registra un cluster insertado o actualizado sin ORM; se aplica al confirmar."""
+    cluster_changes.add(session, ("put", (robot_id, label), dict(cluster)))
+
+
+def note_removed(session, robot_id, label, cluster_id):
+    """Registra un cluster borrado sin ORM; se quita de la caché al confirmar."""
+    cluster_changes.add(session, ("remove", (robot_id, label), cluster_id))
+
+
+def note_changed(session, robot_id=None, label=None):
+    """
+    Registra un cambio masivo en temp_detections (o solo en un robot y
+    label); la caché se descarta al confirmar.
+    """
+    key = None if robot_id is None else (robot_id, label)
+    cluster_changes.add(session, ("invalidate", key))
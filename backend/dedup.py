@@ -0,0 +1,194 @@
+# --------------------
+# Este archivo Python contiene el motor vectorizado (NumPy) que
+# descarta detecciones duplicadas durante la inserción
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import math
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import select, or_, and_
+
+from changes import SYNC_SAFETY_WINDOW, TOMBSTONE_TTL
+from models import DetectionTombstone
+from spatial import DEDUP_RADIUS
+
+
+def duplicate_mask(stored, incoming, radius=DEDUP_RADIUS):
+    """
+    Para cada punto de `incoming` (m, 2), indica si alguno de `stored` (n, 2),
+    ordenado por x, está a menos de `radius`. Solo se comparan los puntos de
+    la franja [x - radius, x + radius] y con distancias al cuadrado.
+    """
+    if len(stored) == 0 or len(incoming) == 0:
+        return np.zeros(len(incoming), dtype=bool)
+
+    lo = np.searchsorted(stored[:, 0], incoming[:, 0] - radius, side="left")
+    hi = np.searchsorted(stored[:, 0], incoming[:, 0] + radius, side="right")
+    counts = hi - lo
+    # Pares (punto entrante, candidato) de todas las franjas a la vez
+    owner = np.repeat(np.arange(len(incoming)), counts)
+    candidate = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    diff = stored[candidate] - incoming[owner]
+    close = (diff ** 2).sum(axis=1) < radius ** 2
+
+    mask = np.zeros(len(incoming), dtype=bool)
+    mask[owner[close]] = True
+    return mask
+
+
+def greedy_owners(points, skip=None, radius=DEDUP_RADIUS):
+    """
+    Recorre `points` (m, 2) en orden y une cada punto al primero de los ya
+    aceptados que esté a menos de `radius`; si no hay ninguno, se acepta.
+    Devuelve para cada punto el índice del aceptado al que se une (él mismo
+    si se acepta, -1 si está en `skip`). Los aceptados quedan separados al
+    menos `radius`, así que en cada celda de lado `radius` caben pocos y cada
+    punto solo se compara con los de las 3x3 celdas de alrededor: memoria y
+    tiempo lineales en m.
+    """
+    owners = np.full(len(points), -1, dtype=np.int64)
+    cells = defaultdict(list)
+    limit = radius ** 2
+    coords = np.asarray(points, dtype=float).reshape(-1, 2).tolist()
+    for j, (x, y) in enumerate(coords):
+        if skip is not None and skip[j]:
+            continue
+        cx, cy = math.floor(x / radius), math.floor(y / radius)
+        owner = j
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for k in cells.get((cx + dx, cy + dy), ()):
+                    if k < owner and (coords[k][0] - x) ** 2 + (coords[k][1] - y) ** 2 < limit:
+                        owner = k
+        owners[j] = owner
+        if owner == j:
+            cells[(cx, cy)].append(j)
+    return owners
+
+
+class _Entry:
+    """Puntos de una clave ordenados por x, con sus ids y cuándo se leyeron de la BD."""
+
+    __slots__ = ("ids", "points", "checked")
+
+    def __init__(self, ids, points, checked):
+        order = np.argsort(points[:, 0], kind="stable")
+        self.ids = ids[order]
+        self.points = points[order]
+        self.checked = checked
+
+    @classmethod
+    def from_rows(cls, rows, checked):
+        rows = np.array(rows, dtype=float).reshape(-1, 3)
+        return cls(rows[:, 0].astype(np.int64), rows[:, 1:], checked)
+
+    def merge(self, rows, removed, checked):
+        """Entrada con las filas (id, x, y) cambiadas y sin las de los ids de `removed`."""
+        if not rows and not removed:
+            entry = _Entry.__new__(_Entry)
+            entry.ids, entry.points, entry.checked = self.ids, self.points, checked
+            return entry
+        changed = _Entry.from_rows(rows, checked)
+        keep = ~np.isin(self.ids, np.concatenate([changed.ids, np.array(removed, dtype=np.int64)]))
+        return _Entry(
+            np.concatenate([self.ids[keep], changed.ids]), np.vstack([self.points[keep], changed.points]), checked
+        )
+
+
+class DedupEngine:
+    """
+    Guarda en memoria las coordenadas (x, y) de las detecciones por tabla,
+    robot y label, ordenadas por x. Cada clave se lee entera la primera vez;
+    después, antes de cada uso, solo se leen los cambios desde la última
+    comprobación (con el margen de SYNC_SAFETY_WINDOW): las filas con
+    updated_at posterior (índice robot/updated_at) y las lápidas de los
+    borrados. Así se ven también los cambios de otros procesos y el coste
+    depende de lo que ha cambiado, no del tamaño de la tabla. Una clave sin
+    comprobar durante TOMBSTONE_TTL se vuelve a leer entera, porque sus
+    lápidas pueden haberse borrado ya.
+    """
+
+    def __init__(self, radius=DEDUP_RADIUS):
+        self.radius = radius
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _load(self, db, model, keys):
+        table = model.__tablename__
+        # Se toma antes de leer: lo que se escriba durante la lectura entra en la próxima
+        checked = datetime.utcnow()
+        with self._lock:
+            entries = {k: self._entries.get((table, *k)) for k in keys}
+        known = {k: e for k, e in entries.items() if e is not None and checked - e.checked < TOMBSTONE_TTL}
+
+        result = {}
+        if known:
+            since = min(e.checked for e in known.values()) - SYNC_SAFETY_WINDOW
+            robots = {robot_id for robot_id, _ in known}
+            changed, removed = defaultdict(list), defaultdict(list)
+            for robot_id, label, id_, x, y in db.execute(
+                select(model.robot_id, model.label, model.id, model.obj_x, model.obj_y)
+                .where(model.robot_id.in_(robots), model.updated_at >= since)
+            ):
+                # Una fila que cambia de label o pierde la posición sale de su clave
+                for key in known:
+                    if key[0] == robot_id:
+                        if key[1] == label and x is not None:
+                            changed[key].append((id_, x, y))
+                        else:
+                            removed[key].append(id_)
+            deleted = defaultdict(list)
+            for robot_id, detection_id in db.execute(
+                select(DetectionTombstone.robot_id, DetectionTombstone.detection_id).where(
+                    DetectionTombstone.source_table == table,
+                    DetectionTombstone.robot_id.in_(robots),
+                    DetectionTombstone.deleted_at >= since
+                )
+            ):
+                deleted[robot_id].append(detection_id)
+            for key, entry in known.items():
+                result[key] = entry.merge(changed[key], removed[key] + deleted[key[0]], checked)
+
+        missing = [k for k in keys if k not in result]
+        if missing:
+            loaded = defaultdict(list)
+            for robot_id, label, *row in db.execute(
+                select(model.robot_id, model.label, model.id, model.obj_x, model.obj_y)
+                .where(_keys_filter(model, missing), model.obj_x.is_not(None))
+            ):
+                loaded[(robot_id, label)].append(row)
+            for key in missing:
+                result[key] = _Entry.from_rows(loaded[key], checked)
+
+        with self._lock:
+            self._entries.update({(table, *k): v for k, v in result.items()})
+        return {k: v.points for k, v in result.items()}
+
+    def duplicates(self, db, model, robot_id, label, points):
+        """Máscara de los `points` (m, 2) que ya tienen un vecino guardado en `model`."""
+        stored = self._load(db, model, [(robot_id, label)])[(robot_id, label)]
+        return duplicate_mask(stored, np.asarray(points, dtype=float).reshape(-1, 2), self.radius)
+
+    def stored(self, db, model, keys):
+        """Coordenadas guardadas de varias claves (robot_id, label), puestas al día con la BD."""
+        return self._load(db, model, keys)
+
+    def invalidate(self, table=None, robot_id=None, label=None):
+        with self._lock:
+            if table is None:
+                self._entries.clear()
+            elif robot_id is None:
+                self._entries = {k: v for k, v in self._entries.items() if k[0] != table}
+            else:
+                self._entries.pop((table, robot_id, label), None)
+
+
+def _keys_filter(model, keys):
+    return or_(*[and_(model.robot_id == robot_id, model.label == label) for robot_id, label in keys])
+
+
+dedup_engine = DedupEngine()
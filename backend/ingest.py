@@ -0,0 +1,322 @@
+# --------------------
+# Este archivo Python contiene la inserción por lotes de las
+# detecciones que envía el robot (POST /detections y /detections/temp)
+# y el paso por lotes de detecciones temporales a definitivas
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+from collections import defaultdict
+
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import insert, select, delete, update, literal, bindparam, func, cast, Integer
+
+from changes import tombstones_for
+from clusters import (
+    cluster_index, should_promote,
+    note_updated as note_cluster_updated, note_removed as note_cluster_removed, note_changed as note_clusters_changed,
+)
+from dedup import dedup_engine, duplicate_mask, greedy_owners
+from models import Detection, TempDetection, position_columns
+from rooms import room_resolver
+
+
+def _dedup_groups(db, groups, check_models):
+    """
+    Para cada grupo (robot_id, label) -> array (m, 2) de puntos, devuelve el
+    motivo de rechazo de cada punto: la tabla donde ya hay un vecino, "batch"
+    si choca con uno anterior del mismo lote, o None si se acepta.
+    """
+    stored = [(m.__tablename__, dedup_engine.stored(db, m, list(groups))) for m in check_models]
+    reasons = {}
+    for key, points in groups.items():
+        group_reasons = np.full(len(points), None, dtype=object)
+        for table, arrays in reversed(stored):
+            group_reasons[duplicate_mask(arrays[key], points)] = table
+
+        # Dentro del lote gana el primero que llega
+        owners = greedy_owners(points, skip=np.not_equal(group_reasons, None))
+        group_reasons[(owners >= 0) & (owners != np.arange(len(points)))] = "batch"
+        reasons[key] = group_reasons
+    return reasons
+
+
+def ingest_markers(db, markers, model, check_models, extra_fields=None):
+    """
+    Inserta un lote de marcadores en `model` en una sola sentencia.
+
+    Un marcador se rechaza si hay otro del mismo robot y label a menos del
+    radio en alguna de las tablas de `check_models` o antes en el mismo lote.
+    Devuelve un resultado por marcador, en el mismo orden.
+    """
+    results = [
+        {"index": index, "label": marker.name, "accepted": False, "id": None}
+        for index, marker in enumerate(markers)
+    ]
+
+    groups = defaultdict(list)
+    for index, marker in enumerate(markers):
+        groups[(marker.robot_id, marker.name)].append(index)
+    points = {
+        key: np.array([[markers[i].position_obj.x, markers[i].position_obj.y] for i in indexes])
+        for key, indexes in groups.items()
+    }
+    reasons = _dedup_groups(db, points, check_models)
+
+    accepted = []
+    for key, indexes in groups.items():
+        for j, i in enumerate(indexes):
+            if reasons[key][j] is not None:
+                results[i]["duplicate_of"] = reasons[key][j]
+            else:
+                accepted.append(i)
+
+    if not accepted:
+        return results
+
+    accepted.sort()
+    room_ids = room_resolver.resolve(db, [(markers[i].position_obj.x, markers[i].position_obj.y) for i in accepted])
+    rows = []
+    for i, room_id in zip(accepted, room_ids):
+        marker = markers[i]
+        new_pos = {
+            "x": marker.position_obj.x,
+            "y": marker.position_obj.y,
+            "z": marker.position_obj.z
+        }
+        row = {
+            "label": marker.name,
+            "position_obj": new_pos,
+            "position_nav": marker.position_nav.__json__(),
+            "robot_id": marker.robot_id,
+            "room_id": room_id,
+            **position_columns(new_pos, marker.position_nav.__json__()),
+        }
+        if extra_fields:
+            row.update(extra_fields(marker))
+        rows.append(row)
+        results[i]["room_id"] = room_id
+
+    # insertmanyvalues: un INSERT multi-fila con los ids en el orden de los parámetros
+    inserted = db.execute(insert(model).returning(model.id, sort_by_parameter_order=True), rows)
+    for i, new_id in zip(accepted, inserted.scalars()):
+        results[i]["accepted"] = True
+        results[i]["id"] = new_id
+
+    return results
+
+
+def _observe_cluster(db, cluster, delta):
+    """
+    Suma al cluster guardado las observaciones de `delta` en relativo (hits,
+    media ponderada del centroide con las columnas de la fila y confianza
+    noisy-OR), así no se pierden las que haya sumado otra petición u otro
+    proceso. Actualiza `cluster` con lo que queda en la BD y devuelve False
+    si la fila ya no existe.
+    """
+    table = TempDetection.__table__
+    hits = func.coalesce(table.c.hits, 1)
+    row = db.execute(
+        update(table).where(table.c.id == cluster["id"]).values(
+            hits=hits + delta["n"],
+            obj_x=(table.c.obj_x * hits + delta["x"]) / (hits + delta["n"]),
+            obj_y=(table.c.obj_y * hits + delta["y"]) / (hits + delta["n"]),
+            confidence=cast(func.round(100 - (100 - func.coalesce(table.c.confidence, 0)) * delta["miss"]), Integer),
+        ).returning(table.c.hits, table.c.obj_x, table.c.obj_y, table.c.confidence, table.c.position_obj)
+    ).first()
+    if row is None:
+        return False
+
+    # La z solo está en el JSON: la fila queda bloqueada hasta el commit, así
+    # que el JSON leído corresponde a los hits de antes de esta suma
+    before = row.hits - delta["n"]
+    z = (row.position_obj or {}).get("z") or 0
+    cluster.update(
+        x=row.obj_x, y=row.obj_y, z=(z * before + delta["z"]) / row.hits, hits=row.hits, confidence=row.confidence
+    )
+    return True
+
+
+def cluster_temp_markers(db, markers):
+    """
+    Añade un lote de marcadores a los clusters de temp_detections. Cada
+    marcador se une al cluster más cercano del mismo robot y label (mueve su
+    centroide, suma un hit y acumula su confianza) o abre uno nuevo. Se
+    rechazan los que ya tienen cerca una detección guardada, y los clusters
+    que pasan el umbral se promocionan a detections en la misma transacción.
+    Devuelve (resultado por marcador, estado de los clusters tocados).
+    """
+    results = [
+        {"index": index, "label": marker.name, "accepted": False, "id": None}
+        for index, marker in enumerate(markers)
+    ]
+
+    groups = defaultdict(list)
+    for index, marker in enumerate(markers):
+        groups[(marker.robot_id, marker.name)].append(index)
+    points = {
+        key: np.array([[markers[i].position_obj.x, markers[i].position_obj.y] for i in indexes])
+        for key, indexes in groups.items()
+    }
+    stored = dedup_engine.stored(db, Detection, list(groups))
+
+    touched = []
+    for key, indexes in groups.items():
+        rejected = duplicate_mask(stored[key], points[key])
+        batch = cluster_index.batch(db, key)
+        for j, i in enumerate(indexes):
+            if rejected[j]:
+                results[i]["duplicate_of"] = Detection.__tablename__
+                continue
+            marker = markers[i]
+            cluster = batch.observe(
+                marker.position_obj.x, marker.position_obj.y, marker.position_obj.z,
+                int(marker.confidence), marker.position_nav.__json__()
+            )
+            results[i]["cluster"] = cluster
+        touched.extend((key, cluster, batch.deltas[cluster["id"]]) for cluster in batch.touched.values())
+
+    if not touched:
+        return results, []
+
+    # La caché solo decide a qué cluster va cada marcador; los valores de los
+    # que ya existen se suman en la BD
+    for key, cluster, delta in touched:
+        if cluster["id"] > 0 and not _observe_cluster(db, cluster, delta):
+            # Promocionado o compactado por otro proceso: se abre de nuevo
+            # solo con las observaciones de este lote
+            note_clusters_changed(db, *key)
+            n = delta["n"]
+            cluster.update(
+                id=-cluster["id"], x=delta["x"] / n, y=delta["y"] / n, z=delta["z"] / n,
+                hits=n, confidence=round(100 - 100 * delta["miss"])
+            )
+    touched = [(key, cluster) for key, cluster, _ in touched]
+
+    room_ids = room_resolver.resolve(db, [(c["x"], c["y"]) for _, c in touched])
+    inserts, updates = [], []
+    for (key, cluster), room_id in zip(touched, room_ids):
+        cluster["room_id"] = room_id
+        position_obj = {"x": cluster["x"], "y": cluster["y"], "z": cluster["z"]}
+        columns = {"position_obj": position_obj, "room_id": room_id, **position_columns(position_obj)}
+        if cluster["id"] < 0:
+            inserts.append((cluster, {
+                "label": key[1], "robot_id": key[0], "position_nav": cluster["nav"],
+                "hits": cluster["hits"], "confidence": cluster["confidence"],
+                **columns, **position_columns(position_nav=cluster["nav"]),
+            }))
+        else:
+            updates.append({"_id": cluster["id"], **{f"_{n}": v for n, v in columns.items()}})
+
+    if updates:
+        # JSON, celdas y habitación a partir del centroide ya sumado
+        table = TempDetection.__table__
+        names = [n[1:] for n in updates[0] if n != "_id"]
+        db.execute(
+            update(table).where(table.c.id == bindparam("_id")).values(**{n: bindparam(f"_{n}") for n in names}),
+            updates
+        )
+    if inserts:
+        inserted = db.execute(
+            insert(TempDetection).returning(TempDetection.id, sort_by_parameter_order=True),
+            [row for _, row in inserts]
+        )
+        for (cluster, _), new_id in zip(inserts, inserted.scalars()):
+            cluster["id"] = new_id
+
+    for key, cluster in touched:
+        note_cluster_updated(db, *key, cluster)
+
+    promoted = set()
+    ready = [cluster["id"] for _, cluster in touched if should_promote(cluster)]
+    if ready:
+        promoted.update(promote_temp_detections(db, TempDetection.id.in_(ready))[0])
+
+    for result in results:
+        cluster = result.pop("cluster", None)
+        if cluster is not None:
+            result.update(
+                accepted=True, id=cluster["id"], room_id=cluster["room_id"], hits=cluster["hits"],
+                confidence=cluster["confidence"], promoted=cluster["id"] in promoted
+            )
+
+    clusters = [
+        {
+            "id": cluster["id"],
+            "label": key[1],
+            "position_obj": {"x": cluster["x"], "y": cluster["y"], "z": cluster["z"]},
+            "position_nav": cluster["nav"],
+            "robot_id": key[0],
+            "room_id": cluster["room_id"],
+            "confidence": cluster["confidence"],
+            "hits": cluster["hits"],
+            "promoted": cluster["id"] in promoted,
+        }
+        for key, cluster in touched
+    ]
+    return results, clusters
+
+
+# Columnas que se copian de temp_detections a detections al promocionar
+PROMOTED_COLUMNS = [
+    "label", "position_obj", "position_nav", "robot_id", "room_id",
+    "obj_x", "obj_y", "nav_x", "nav_y", "cell_x", "cell_y",
+]
+
+
+def promote_temp_detections(db, *where):
+    """
+    Pasa a `detections` todas las detecciones temporales que cumplen `where`
+    en una sola transacción (INSERT ... SELECT y DELETE). Las que chocan con
+    una detección guardada, o con otra anterior del mismo lote, se quedan
+    como temporales. Devuelve (ids promocionados, conflictos).
+    """
+    temps = db.execute(
+        select(TempDetection.id, TempDetection.robot_id, TempDetection.label,
+               TempDetection.obj_x, TempDetection.obj_y, TempDetection.room_id)
+        .where(*where).order_by(TempDetection.id)
+    ).all()
+
+    groups = defaultdict(list)
+    for temp in temps:
+        groups[(temp.robot_id, temp.label)].append(temp)
+    points = {
+        key: np.array([[t.obj_x, t.obj_y] for t in rows])
+        for key, rows in groups.items()
+    }
+    reasons = _dedup_groups(db, points, [Detection])
+
+    promoted, conflicts = [], []
+    for key, rows in groups.items():
+        for temp, reason in zip(rows, reasons[key]):
+            if reason is None:
+                promoted.append(temp.id)
+                note_cluster_removed(db, *key, temp.id)
+            else:
+                conflicts.append({"id": temp.id, "duplicate_of": reason})
+
+    if promoted:
+        # Las habitaciones pueden haber cambiado desde que se guardaron las
+        # temporales: se corrigen antes de copiarlas
+        by_id = {temp.id: temp for temp in temps}
+        room_ids = room_resolver.resolve(db, [(by_id[i].obj_x, by_id[i].obj_y) for i in promoted])
+        moved = [{"_id": i, "_room_id": r} for i, r in zip(promoted, room_ids) if r != by_id[i].room_id]
+        if moved:
+            table = TempDetection.__table__
+            db.execute(
+                update(table).where(table.c.id == bindparam("_id")).values(room_id=bindparam("_room_id")),
+                moved
+            )
+
+        now = datetime.utcnow()
+        selected = TempDetection.id.in_(promoted)
+        db.execute(insert(Detection).from_select(
+            [*PROMOTED_COLUMNS, "created_at", "updated_at"],
+            select(*[getattr(TempDetection, c) for c in PROMOTED_COLUMNS], literal(now), literal(now))
+            .where(selected)
+        ))
+        db.execute(tombstones_for(TempDetection, selected))
+        db.execute(delete(TempDetection).where(selected))
+
+    return sorted(promoted), sorted(conflicts, key=lambda c: c["id"])
@@ -0,0 +1,182 @@
+# --------------------
+# Este archivo Python contiene el índice de labels normalizados que
+# resuelve texto libre (comandos de voz) a detecciones guardadas
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import bisect
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import select
+
+from changes import SYNC_SAFETY_WINDOW, TOMBSTONE_TTL
+from models import Detection, DetectionTombstone
+
+ARTICLES = {"el", "la", "los", "las", "un", "una", "unos", "unas", "al", "del", "lo", "the", "a", "an"}
+
+# Conectores que separan el objeto de la habitación ("silla del salón")
+ROOM_CONNECTORS = re.compile(r"\s+(?:de la|del|de los|de las|en el|en la|in the|of the|in|en|de)\s+")
+
+# Similitud mínima de trigramas para aceptar una coincidencia aproximada
+MIN_SIMILARITY = 0.4
+
+
+def fold(text):
+    """Minúsculas, sin tildes y sin signos."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(re.sub(r"[^a-z0-9]+", " ", text).split())
+
+
+def normalize(text):
+    """Como fold, pero además sin artículos."""
+    return " ".join(w for w in fold(text).split() if w not in ARTICLES)
+
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class LabelIndex:
+    """
+    Índice por robot de los labels de sus detecciones. Guarda para cada label
+    normalizado las detecciones que lo tienen, los labels ordenados (búsqueda
+    por prefijo) y un índice invertido de trigramas (búsqueda aproximada).
+    El coste de una búsqueda depende del número de labels distintos, no del
+    número de detecciones. Como en DedupEngine, antes de cada búsqueda se
+    leen las detecciones cambiadas y las lápidas desde la última vez, así
+    que se ven los cambios de otros procesos.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._robots = {}
+
+    async def _ensure_loaded(self, db, robot_id):
+        # Se toma antes de leer: lo que se escriba durante la lectura entra en la próxima
+        checked = datetime.utcnow()
+        with self._lock:
+            entry = self._robots.get(robot_id)
+
+        if entry is None or checked - entry["checked"] >= TOMBSTONE_TTL:
+            rows = await db.execute(
+                select(Detection.id, Detection.label, Detection.room_id).where(Detection.robot_id == robot_id)
+            )
+            entry = {"labels": defaultdict(dict), "sorted": [], "trigrams": defaultdict(set), "ids": {},
+                     "checked": checked}
+            for detection_id, label, room_id in rows:
+                self._add(entry, detection_id, label, room_id)
+            with self._lock:
+                self._robots[robot_id] = entry
+            return entry
+
+        since = entry["checked"] - SYNC_SAFETY_WINDOW
+        changed = (await db.execute(
+            select(Detection.id, Detection.label, Detection.room_id)
+            .where(Detection.robot_id == robot_id, Detection.updated_at >= since)
+        )).all()
+        deleted = (await db.scalars(select(DetectionTombstone.detection_id).where(
+            DetectionTombstone.source_table == Detection.__tablename__,
+            DetectionTombstone.robot_id == robot_id,
+            DetectionTombstone.deleted_at >= since
+        ))).all()
+
+        with self._lock:
+            # Si otra búsqueda ya aplicó cambios más recientes, estos sobran
+            if checked > entry["checked"]:
+                for detection_id, label, room_id in changed:
+                    self._remove(entry, detection_id)
+                    self._add(entry, detection_id, label, room_id)
+                for detection_id in deleted:
+                    self._remove(entry, detection_id)
+                entry["checked"] = checked
+        return entry
+
+    @staticmethod
+    def _add(entry, detection_id, label, room_id):
+        key = normalize(label or "")
+        if key not in entry["labels"]:
+            bisect.insort(entry["sorted"], key)
+            for gram in trigrams(key):
+                entry["trigrams"][gram].add(key)
+        entry["labels"][key][detection_id] = room_id
+        entry["ids"][detection_id] = key
+
+    @staticmethod
+    def _remove(entry, detection_id):
+        # El label se queda en el índice aunque se vacíe; se ignora al buscar
+        key = entry["ids"].pop(detection_id, None)
+        if key is not None:
+            entry["labels"][key].pop(detection_id, None)
+
+    def invalidate(self, robot_id=None):
+        with self._lock:
+            if robot_id is None:
+                self._robots.clear()
+            else:
+                self._robots.pop(robot_id, None)
+
+    @staticmethod
+    def _candidates(entry, text):
+        """Labels normalizados que casan con `text`, con su puntuación (1 = exacto)."""
+        if not text:
+            return []
+        if entry["labels"].get(text):
+            return [(text, 1.0)]
+
+        i = bisect.bisect_left(entry["sorted"], text)
+        prefixed = []
+        while i < len(entry["sorted"]) and entry["sorted"][i].startswith(text):
+            prefixed.append((entry["sorted"][i], 0.9))
+            i += 1
+        if prefixed:
+            return [c for c in prefixed if entry["labels"].get(c[0])]
+
+        grams = trigrams(text)
+        shared = defaultdict(int)
+        for gram in grams:
+            for key in entry["trigrams"].get(gram, ()):
+                shared[key] += 1
+        scored = [
+            (key, count / len(grams | trigrams(key)))
+            for key, count in shared.items() if entry["labels"].get(key)
+        ]
+        return sorted((c for c in scored if c[1] >= MIN_SIMILARITY), key=lambda c: -c[1])
+
+    async def resolve(self, db, robot_id, text, rooms):
+        """
+        Busca las detecciones del robot que mejor casan con `text`. Si el texto
+        acaba en una de las habitaciones de `rooms` ({nombre normalizado: id}),
+        solo se devuelven las de esa habitación.
+        """
+        entry = await self._ensure_loaded(db, robot_id)
+        folded = f" {fold(text)} "
+
+        # Si el texto nombra una habitación conocida, solo se busca en ella
+        attempts = [
+            (normalize(folded[:match.start()]), normalize(folded[match.end():]))
+            for match in ROOM_CONNECTORS.finditer(folded)
+            if normalize(folded[match.end():]) in rooms
+        ] or [(normalize(folded), None)]
+
+        for label_text, room_name in attempts:
+            with self._lock:
+                candidates = self._candidates(entry, label_text)
+                matches = [
+                    (key, score, [i for i, r in entry["labels"][key].items()
+                                  if room_name is None or r == rooms[room_name]])
+                    for key, score in candidates
+                ]
+            matches = [m for m in matches if m[2]]
+            if matches:
+                key, score, ids = matches[0]
+                return {"label": key, "room": room_name, "score": score, "ids": sorted(ids)}
+        return {"label": None, "room": attempts[0][1], "score": 0, "ids": []}
+
+
+label_index = LabelIndex()
@@ -3,17 +3,42 @@
 # Autor: Jaime Varas Cáceres
 # --------------------
 
-from fastapi import FastAPI, APIRouter, Depends, Form
+import asyncio
+import os
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, APIRouter, Depends, Form, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from auth import create_access_token, authenticate_user, hash_password, get_db
+from auth import (
+    create_access_token, authenticate_user, hash_password_async, get_async_db, get_current_user,
+    principal_cache, password_hasher
+)
 from database import engine, Base
+from maintenance import maintenance_loop, MAINTENANCE_INTERVAL
+from migrations import run_migrations
 from models import User
+from ownership import ownership_cache
 from routes import detections, ros, robots
+from snapshots import map_snapshots
+from tunnel import close_tunnel_client
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Caducidad y compactación periódica de temp_detections
+    task = asyncio.create_task(maintenance_loop()) if MAINTENANCE_INTERVAL > 0 else None
+    yield
+    if task:
+        task.cancel()
+    await close_tunnel_client()
+
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 Base.metadata.create_all(bind=engine)
+run_migrations(engine)
 
 origins = [
     "https://ros-web-app-backend.onrender.com",
@@ -28,6 +53,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 
@@ -37,20 +63,20 @@ async def root():
 
 
 @app.post("/signup")
-def signup(username: str = Form(), password: str = Form(), db: Session = Depends(get_db)):
-    existing_user = db.query(User).filter(User.username == username).first()
+async def signup(username: str = Form(), password: str = Form(), db: AsyncSession = Depends(get_async_db)):
+    existing_user = await db.scalar(select(User).where(User.username == username))
     if existing_user:
         return {"error": "Ya existe un usuario con ese nombre"}
 
-    new_user = User(username=username, hashed_password=hash_password(password))
+    new_user = User(username=username, hashed_password=await hash_password_async(password))
     db.add(new_user)
-    db.commit()
+    await db.commit()
     return {"message": "Usuario creado"}
 
 
 @app.post("/login")
-def login(username: str = Form(), password: str = Form(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, username, password)
+async def login(username: str = Form(), password: str = Form(), db: AsyncSession = Depends(get_async_db)):
+    user = await authenticate_user(db, username, password)
     if not user:
         return {"error": "Credenciales inválidos"}
 
@@ -58,6 +84,27 @@ def login(username: str = Form(), password: str = Form(), db: Session = Depends(
     return {"access_token": token}
 
 
+# Usuarios (separados por comas) que pueden ver /stats; por defecto nadie
+STATS_ADMINS = {u for u in os.environ.get('STATS_ADMINS', '').split(',') if u}
+
+
+@app.get("/stats", include_in_schema=False)
+async def cache_stats(current_user: User = Depends(get_current_user)):
+    # Son contadores de todo el servidor, no de un usuario
+    if current_user.username not in STATS_ADMINS:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You don't have permission to do that"
+        )
+
+    return {
+        "principals": principal_cache.stats(),
+        "ownership": ownership_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "map_snapshots": map_snapshots.stats(),
+    }
+
+
 api_router = APIRouter()
 api_router.include_router(detections.router)
 api_router.include_router(ros.router)
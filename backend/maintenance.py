@@ -0,0 +1,115 @@
+# --------------------
+# Este archivo Python contiene las tareas de mantenimiento periódicas
+# de la tabla temp_detections (caducidad y compactación)
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import asyncio
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select, delete, update, bindparam, func
+
+from changes import tombstones_for, TOMBSTONE_TTL
+from database import SessionLocal
+from clusters import note_changed as note_clusters_changed
+from dedup import greedy_owners
+from models import TempDetection, DetectionTombstone
+from spatial import DEDUP_RADIUS
+
+# Las detecciones temporales que no se han vuelto a ver en este tiempo se borran
+TEMP_DETECTION_TTL = timedelta(minutes=float(os.environ.get('TEMP_DETECTION_TTL_MINUTES', 24 * 60)))
+# Segundos entre dos pasadas de mantenimiento (0 para desactivarlo)
+MAINTENANCE_INTERVAL = float(os.environ.get('MAINTENANCE_INTERVAL_SECONDS', 600))
+# Ids por sentencia al borrar (límite de parámetros de la BD)
+DELETE_BATCH = 1000
+
+
+def _delete_temp(db, ids):
+    for start in range(0, len(ids), DELETE_BATCH):
+        selected = TempDetection.id.in_(ids[start:start + DELETE_BATCH])
+        db.execute(tombstones_for(TempDetection, selected))
+        db.execute(delete(TempDetection).where(selected))
+
+
+def compact_temp_detections(db, max_age=TEMP_DETECTION_TTL, radius=DEDUP_RADIUS, robot_id=None):
+    """
+    Borra las detecciones temporales caducadas y junta las que quedan a menos
+    de `radius` entre sí (mismo robot y label) en una sola fila por grupo:
+    se queda la de mayor confianza y suma los hits de las demás. Con
+    `robot_id` solo se tocan las de ese robot.
+    Devuelve cuántas filas se han borrado por cada motivo.
+    """
+    scope = [] if robot_id is None else [TempDetection.robot_id == robot_id]
+    expired = TempDetection.updated_at < datetime.utcnow() - max_age
+    expired_ids = db.scalars(select(TempDetection.id).where(expired, *scope)).all()
+    if expired_ids:
+        _delete_temp(db, expired_ids)
+
+    # Solo los (robot, label) con más de una fila, y de uno en uno: en
+    # memoria no hay más que las filas de un grupo
+    keys = db.execute(
+        select(TempDetection.robot_id, TempDetection.label)
+        .where(TempDetection.obj_x.is_not(None), *scope)
+        .group_by(TempDetection.robot_id, TempDetection.label)
+        .having(func.count() > 1)
+    ).all()
+
+    table = TempDetection.__table__
+    merged_ids = []
+    for robot_id, label in keys:
+        group = db.execute(
+            select(TempDetection.id, TempDetection.obj_x, TempDetection.obj_y, TempDetection.hits)
+            .where(TempDetection.robot_id == robot_id, TempDetection.label == label,
+                   TempDetection.obj_x.is_not(None))
+            .order_by(TempDetection.confidence.desc().nulls_last(), TempDetection.id)
+        ).all()
+        # Recorridas por confianza: cada fila se une a la primera superviviente cercana
+        owners = greedy_owners(np.array([[r.obj_x, r.obj_y] for r in group]), radius=radius)
+        merged, hits = [], {}
+        for j, keeper in enumerate(owners):
+            if keeper != j:
+                merged.append(group[j].id)
+                kept = group[keeper].id
+                hits[kept] = hits.get(kept, group[keeper].hits or 1) + (group[j].hits or 1)
+        if merged:
+            db.execute(
+                update(table).where(table.c.id == bindparam("_id")).values(hits=bindparam("_hits")),
+                [{"_id": i, "_hits": h} for i, h in hits.items()]
+            )
+            _delete_temp(db, merged)
+            merged_ids.extend(merged)
+
+    pruned = DetectionTombstone.deleted_at < datetime.utcnow() - TOMBSTONE_TTL
+    if robot_id is not None:
+        pruned &= DetectionTombstone.robot_id == robot_id
+    tombstones = db.execute(delete(DetectionTombstone).where(pruned)).rowcount
+
+    if expired_ids or merged_ids:
+        note_clusters_changed(db)
+    return {
+        "expired": len(expired_ids),
+        "merged": len(merged_ids),
+        "removed": len(expired_ids) + len(merged_ids),
+        "tombstones_pruned": tombstones,
+    }
+
+
+def run_maintenance():
+    with SessionLocal() as db:
+        report = compact_temp_detections(db)
+        db.commit()
+    return report
+
+
+async def maintenance_loop(interval=MAINTENANCE_INTERVAL):
+    """Tarea en segundo plano que lanza el mantenimiento cada `interval` segundos."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            report = await run_in_threadpool(run_maintenance)
+            print(f"Temp detections maintenance: {report}")
+        except Exception as e:
+            print(f"Temp detections maintenance failed: {e}")
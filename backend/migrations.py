@@ -0,0 +1,78 @@
+# --------------------
+# Este archivo Python aplica los cambios de esquema que
+# create_all no hace sobre tablas ya existentes
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+from datetime import datetime
+
+from sqlalchemy import inspect, text, update, select, bindparam, or_
+
+from models import Detection, TempDetection, position_columns
+
+# Filas que se actualizan por lote al rellenar columnas nuevas
+BACKFILL_BATCH = 1000
+
+
+def _add_missing_columns(conn, table, columns):
+    existing = {c["name"] for c in inspect(conn).get_columns(table)}
+    added = []
+    for name, ddl_type in columns:
+        if name not in existing:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl_type}"))
+            added.append(name)
+    return added
+
+
+def _backfill_positions(engine, model):
+    # Rellena las columnas derivadas de position_obj/position_nav de las filas
+    # anteriores, sin tocar updated_at para no reenviarlas a los clientes
+    table = model.__table__
+    names = ["obj_x", "obj_y", "nav_x", "nav_y", "cell_x", "cell_y"]
+    statement = (
+        update(table)
+        .where(table.c.id == bindparam("_id"))
+        .values(updated_at=table.c.updated_at, **{n: bindparam(f"_{n}") for n in names})
+    )
+    last_id = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(table.c.id, table.c.position_obj, table.c.position_nav)
+                .where(table.c.id > last_id, or_(table.c.cell_x.is_(None), table.c.obj_x.is_(None)))
+                .order_by(table.c.id)
+                .limit(BACKFILL_BATCH)
+            ).all()
+            if not rows:
+                return
+            params = []
+            for row_id, position_obj, position_nav in rows:
+                columns = dict.fromkeys(names)
+                columns.update(position_columns(position_obj, position_nav))
+                params.append({"_id": row_id, **{f"_{n}": v for n, v in columns.items()}})
+            conn.execute(statement, params)
+            last_id = rows[-1].id
+
+
+def run_migrations(engine):
+    for model in (Detection, TempDetection):
+        table = model.__tablename__
+        with engine.begin() as conn:
+            added = _add_missing_columns(conn, table, [
+                ("cell_x", "INTEGER"), ("cell_y", "INTEGER"),
+                ("created_at", "TIMESTAMP"), ("updated_at", "TIMESTAMP"),
+                ("obj_x", "FLOAT"), ("obj_y", "FLOAT"), ("nav_x", "FLOAT"), ("nav_y", "FLOAT"),
+            ])
+            if "updated_at" in added:
+                now = datetime.utcnow()
+                conn.execute(update(model.__table__).values(created_at=now, updated_at=now))
+        if model is TempDetection:
+            with engine.begin() as conn:
+                if _add_missing_columns(conn, table, [("hits", "INTEGER")]):
+                    conn.execute(update(model.__table__).values(hits=1, updated_at=model.__table__.c.updated_at))
+        # En cada arranque: si se cortó un relleno anterior, sigue con lo que
+        # quedó a NULL (sin nada pendiente es una sola consulta vacía)
+        _backfill_positions(engine, model)
+        # create_all solo crea índices al crear la tabla
+        for index in model.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
@@ -0,0 +1,155 @@
+# --------------------
+# Este archivo Python reparte los streams MJPEG del túnel entre todos
+# los clientes que los están viendo, con una sola conexión al robot
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import asyncio
+import os
+import re
+from contextlib import asynccontextmanager
+
+from broadcast import BroadcastHub
+from tunnel import open_stream
+
+# Frames que se guardan por cliente; si no da abasto se le saltan frames
+MJPEG_CLIENT_BUFFER = int(os.environ.get('MJPEG_CLIENT_BUFFER', 1))
+# Segundos de espera antes de reconectar con el túnel si se corta el stream
+MJPEG_RECONNECT_DELAY = float(os.environ.get('MJPEG_RECONNECT_DELAY', 1))
+
+BOUNDARY = b"frame"
+MEDIA_TYPE = "multipart/x-mixed-replace; boundary=" + BOUNDARY.decode()
+
+
+def _boundary(content_type):
+    match = re.search(r'boundary="?([^";]+)"?', content_type)
+    return (match.group(1) if match else BOUNDARY.decode()).encode()
+
+
+def _content_length(headers):
+    match = re.search(rb"content-length:\s*(\d+)", headers, re.IGNORECASE)
+    return int(match.group(1)) if match else None
+
+
+async def iter_frames(chunks, boundary):
+    """
+    Separa un stream multipart en los cuerpos de sus partes (los JPEG). Si
+    la parte trae Content-Length se corta ahí; si no, en el siguiente
+    delimitador.
+    """
+    delimiter = b"--" + boundary
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer += chunk
+        while True:
+            start = buffer.find(delimiter)
+            if start < 0:
+                del buffer[:max(0, len(buffer) - len(delimiter))]
+                break
+            header_end = buffer.find(b"\r\n\r\n", start)
+            if header_end < 0:
+                del buffer[:start]
+                break
+            body_start = header_end + 4
+            length = _content_length(bytes(buffer[start:header_end]))
+            if length is not None:
+                if len(buffer) < body_start + length:
+                    del buffer[:start]
+                    break
+                body_end = next_start = body_start + length
+            else:
+                next_start = buffer.find(delimiter, body_start)
+                if next_start < 0:
+                    del buffer[:start]
+                    break
+                body_end = next_start
+                if buffer[body_end - 2:body_end] == b"\r\n":
+                    body_end -= 2
+            yield bytes(buffer[body_start:body_end])
+            del buffer[:next_start]
+
+
+def encode_part(frame):
+    return (
+        b"--" + BOUNDARY + b"\r\n"
+        b"Content-Type: image/jpeg\r\n"
+        b"Content-Length: " + str(len(frame)).encode() + b"\r\n\r\n" + frame + b"\r\n"
+    )
+
+
+class MjpegFanout:
+    """
+    Una conexión al túnel por ruta (p. ej. /camera/stream), abierta mientras
+    haya algún cliente viéndola. Cada frame se separa y se codifica una sola
+    vez y se entrega a todos los clientes; a uno lento se le descartan los
+    frames viejos en lugar de acumularlos. Si el túnel no responde con un
+    stream (error de conexión o estado 4xx/5xx) los clientes nuevos reciben
+    la excepción y los que ya estaban se cierran.
+    """
+
+    def __init__(self, client_buffer=MJPEG_CLIENT_BUFFER):
+        self._hub = BroadcastHub(queue_size=client_buffer)
+        self._pumps = {}
+        # Futuro por ruta que se resuelve al conectar con el túnel (o con el error)
+        self._connected = {}
+
+    @asynccontextmanager
+    async def watch(self, path):
+        try:
+            async with self._hub.subscribe(path) as queue:
+                if path not in self._pumps or self._pumps[path].done():
+                    connected = self._connected[path] = asyncio.get_running_loop().create_future()
+                    self._pumps[path] = asyncio.create_task(self._pump(path, connected))
+                yield queue
+        finally:
+            # El último cliente se ha ido: se cierra la conexión con el túnel
+            if self._hub.subscriber_count(path) == 0 and path in self._pumps:
+                self._pumps.pop(path).cancel()
+
+    async def _pump(self, path, connected):
+        while True:
+            streaming = False
+            try:
+                response = await open_stream(path)
+                try:
+                    response.raise_for_status()
+                    streaming = True
+                    if not connected.done():
+                        connected.set_result(None)
+                    boundary = _boundary(response.headers.get("content-type", ""))
+                    async for frame in iter_frames(response.aiter_raw(), boundary):
+                        self._hub.publish(path, encode_part(frame))
+                finally:
+                    await response.aclose()
+            except Exception as e:
+                print(f"MJPEG stream {path} failed: {e}")
+                if not streaming:
+                    # No se ha podido (re)conectar: se cierran los clientes
+                    if not connected.done():
+                        connected.set_exception(e)
+                    self._hub.publish(path, None)
+                    return
+            await asyncio.sleep(MJPEG_RECONNECT_DELAY)
+
+    async def _frames(self, path):
+        async with self.watch(path) as queue:
+            await asyncio.shield(self._connected[path])
+            yield b""
+            while (part := await queue.get()) is not None:
+                yield part
+
+    async def open(self, path):
+        """
+        Se suscribe a `path` y espera a que esté abierta la conexión con el
+        túnel (lanza su excepción si falla). Devuelve el generador con los
+        frames para un StreamingResponse.
+        """
+        frames = self._frames(path)
+        await frames.__anext__()
+        return frames
+
+    def viewer_count(self, path):
+        return self._hub.subscriber_count(path)
+
+
+mjpeg_fanout = MjpegFanout()
@@ -4,14 +4,61 @@
 # Autor: Jaime Varas Cáceres
 # --------------------
 
-from sqlalchemy import Column, Integer, String, JSON, ForeignKey
-from sqlalchemy.orm import relationship
-
-from database import Base
+from datetime import datetime
 
+from sqlalchemy import Column, Integer, String, JSON, ForeignKey, Index, DateTime, Float
+from sqlalchemy.orm import relationship, validates
 
-class Detection(Base):
+from database import Base
+from spatial import cell_of
+
+
+def position_columns(position_obj=None, position_nav=None):
+    """Columnas derivadas de las posiciones JSON (para inserciones sin ORM)."""
+    columns = {}
+    if position_obj is not None:
+        columns["obj_x"], columns["obj_y"] = position_obj["x"], position_obj["y"]
+        columns["cell_x"], columns["cell_y"] = cell_of(position_obj["x"], position_obj["y"])
+    if position_nav is not None:
+        columns["nav_x"], columns["nav_y"] = position_nav["x"], position_nav["y"]
+    return columns
+
+
+class PositionMixin:
+    # Copias en columnas de las posiciones JSON, para filtrar e indexar sin
+    # leer el JSON. El JSON se mantiene para no cambiar las respuestas.
+    obj_x = Column(Float)
+    obj_y = Column(Float)
+    nav_x = Column(Float)
+    nav_y = Column(Float)
+    # Celda de la rejilla espacial de position_obj (ver spatial.py)
+    cell_x = Column(Integer)
+    cell_y = Column(Integer)
+
+    @validates("position_obj", "position_nav")
+    def _update_position_columns(self, key, position):
+        if position is not None:
+            columns = position_columns(**{key: position})
+            for name, value in columns.items():
+                setattr(self, name, value)
+        return position
+
+
+class TimestampMixin:
+    # Para la sincronización incremental (GET /detections/changes)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class Detection(PositionMixin, TimestampMixin, Base):
     __tablename__ = 'detections'
+    __table_args__ = (
+        Index('ix_detections_robot_label', 'robot_id', 'label'),
+        Index('ix_detections_robot_room', 'robot_id', 'room_id'),
+        Index('ix_detections_label_cell', 'label', 'cell_x', 'cell_y'),
+        Index('ix_detections_robot_updated', 'robot_id', 'updated_at'),
+        Index('ix_detections_robot_cell', 'robot_id', 'cell_x', 'cell_y'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     label = Column(String, index=True)
@@ -23,8 +70,14 @@ class Detection(Base):
     room = relationship("Room")
 
 
-class TempDetection(Base):
+class TempDetection(PositionMixin, TimestampMixin, Base):
     __tablename__ = 'temp_detections'
+    __table_args__ = (
+        Index('ix_temp_detections_robot_label', 'robot_id', 'label'),
+        Index('ix_temp_detections_robot_room', 'robot_id', 'room_id'),
+        Index('ix_temp_detections_label_cell', 'label', 'cell_x', 'cell_y'),
+        Index('ix_temp_detections_robot_updated', 'robot_id', 'updated_at'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     label = Column(String, index=True)
@@ -33,10 +86,26 @@ class TempDetection(Base):
     robot_id = Column(Integer, ForeignKey("robots.id"))
     robot = relationship("Robot", back_populates="temp_detections")
     confidence = Column(Integer)
+    # Observaciones agrupadas en esta fila (ver maintenance.py)
+    hits = Column(Integer, default=1)
     room_id = Column(Integer, ForeignKey("rooms.id"))
     room = relationship("Room")
 
 
+class DetectionTombstone(Base):
+    # Registro de las detecciones borradas, para que los clientes las quiten
+    __tablename__ = 'detection_tombstones'
+    __table_args__ = (
+        Index('ix_detection_tombstones_robot_deleted', 'robot_id', 'deleted_at'),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    source_table = Column(String)  # 'detections' o 'temp_detections'
+    detection_id = Column(Integer)
+    robot_id = Column(Integer)
+    deleted_at = Column(DateTime, default=datetime.utcnow)
+
+
 class User(Base):
     __tablename__ = 'users'
 
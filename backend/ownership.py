@@ -0,0 +1,68 @@
+# --------------------
+# Este archivo Python contiene la caché de los robots de cada usuario,
+# que se usa para comprobar la propiedad de un robot sin ir a la BD
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import os
+
+from sqlalchemy import inspect, select
+
+from cache import CommitTracker, TTLCache, flushed
+from models import Robot
+
+# Usuarios cuyos robots se guardan en memoria y durante cuántos segundos
+# (el TTL cubre los cambios hechos fuera del ORM, p. ej. a mano en la BD)
+OWNERSHIP_CACHE_SIZE = int(os.environ.get('OWNERSHIP_CACHE_SIZE', 1024))
+OWNERSHIP_CACHE_TTL = float(os.environ.get('OWNERSHIP_CACHE_TTL', 300))
+
+
+class OwnershipCache:
+    """
+    Caché LRU con caducidad de los robots de cada usuario (id -> datos del
+    robot). Las entradas de los dueños afectados se descartan al confirmar
+    la creación, el cambio de dueño o el borrado de un robot.
+    """
+
+    def __init__(self, maxsize=OWNERSHIP_CACHE_SIZE, ttl=OWNERSHIP_CACHE_TTL):
+        self._cache = TTLCache(maxsize, ttl)
+
+    async def robots_of(self, db, user_id):
+        """Robots del usuario como {robot_id: {"id", "name", "model", "owner_id"}}."""
+        robots = self._cache.get(user_id)
+        if robots is not None:
+            return robots
+        generation = self._cache.generation()
+        rows = await db.execute(
+            select(Robot.id, Robot.name, Robot.model, Robot.owner_id).where(Robot.owner_id == user_id)
+        )
+        robots = {row.id: dict(row._mapping) for row in rows}
+        self._cache.put(user_id, robots, generation)
+        return robots
+
+    async def owns(self, db, user_id, robot_id):
+        return robot_id in await self.robots_of(db, user_id)
+
+    def invalidate(self, user_id=None):
+        self._cache.invalidate(user_id)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+ownership_cache = OwnershipCache()
+
+
+def _changed_owners(session):
+    for robot in flushed(session, Robot):
+        # Dueño actual y, si ha cambiado, el anterior
+        history = inspect(robot).attrs.owner_id.history
+        yield from (o for o in (robot.owner_id, *history.deleted) if o is not None)
+
+
+def _invalidate_owners(user_ids):
+    for user_id in set(user_ids):
+        ownership_cache.invalidate(user_id)
+
+
+robot_owner_changes = CommitTracker("robot_owner_changes", _invalidate_owners, _changed_owners)
@@ -0,0 +1,106 @@
+# --------------------
+# Este archivo Python contiene la caché en memoria de las habitaciones
+# que asigna un room_id a cada punto del mapa
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from cache import CommitTracker, flushed
+from models import Room
+
+# Recarga periódica por si las habitaciones cambian desde otro proceso
+ROOMS_CACHE_TTL = float(os.environ.get('ROOMS_CACHE_TTL', 300))
+
+NO_ROOM = np.iinfo(np.int64).max
+
+
+class RoomResolver:
+    """
+    Índice de los rectángulos de Room por franjas verticales: los bordes x de
+    todas las habitaciones parten el eje en franjas y cada franja guarda las
+    habitaciones que la cubren. Los puntos se sitúan en su franja con una
+    búsqueda binaria y se comprueba su y contra las pocas habitaciones de la
+    franja, todo vectorizado con NumPy.
+    """
+
+    def __init__(self, ttl=ROOMS_CACHE_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._index = None
+        self._loaded_at = None
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def _load(self, db):
+        rects = []
+        for room in db.query(Room).order_by(Room.id).all():
+            start, end = room.position_start, room.position_end
+            rects.append((
+                min(start["x"], end["x"]), max(start["x"], end["x"]),
+                min(start["y"], end["y"]), max(start["y"], end["y"]),
+                room.id
+            ))
+
+        bounds = np.array(sorted({x for r in rects for x in (r[0], r[1])}), dtype=float)
+        # Franja i: [bounds[i], bounds[i + 1]]; se incluyen los bordes
+        slabs = [
+            [(y0, y1, room_id) for x0, x1, y0, y1, room_id in rects if x0 <= left and right <= x1]
+            for left, right in zip(bounds, bounds[1:])
+        ]
+        # Matrices (franjas, habitaciones por franja) con relleno que nunca coincide
+        width = max((len(s) for s in slabs), default=0)
+        y0 = np.full((len(slabs), width), np.inf)
+        y1 = np.full((len(slabs), width), -np.inf)
+        ids = np.zeros((len(slabs), width), dtype=np.int64)
+        for i, slab in enumerate(slabs):
+            for j, (low, high, room_id) in enumerate(slab):
+                y0[i, j], y1[i, j], ids[i, j] = low, high, room_id
+
+        self._index = (bounds, y0, y1, ids)
+        self._loaded_at = time.monotonic()
+
+    def _ensure_loaded(self, db):
+        with self._lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._load(db)
+            return self._index
+
+    @staticmethod
+    def _match(index, slab, valid, ys):
+        _, y0, y1, ids = index
+        slab = np.clip(slab, 0, len(ids) - 1)
+        inside = valid[:, None] & (y0[slab] <= ys[:, None]) & (ys[:, None] <= y1[slab])
+        return np.where(inside, ids[slab], NO_ROOM).min(axis=1, initial=NO_ROOM)
+
+    def resolve(self, db, points):
+        """Devuelve el room_id (0 si ninguno) de cada punto (x, y)."""
+        index = self._ensure_loaded(db)
+        bounds, _, _, ids = index
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        if len(ids) == 0 or len(points) == 0:
+            return [0] * len(points)
+
+        xs, ys = points[:, 0], points[:, 1]
+        slab = np.searchsorted(bounds, xs, side="right") - 1
+        # Un punto sobre un borde interior pertenece también a la franja anterior
+        on_edge = (slab > 0) & (slab <= len(ids)) & (bounds[np.clip(slab, 0, len(bounds) - 1)] == xs)
+        found = np.minimum(
+            self._match(index, slab, (slab >= 0) & (slab < len(ids)), ys),
+            self._match(index, slab - 1, on_edge, ys),
+        )
+        found[found == NO_ROOM] = 0
+        return found.tolist()
+
+
+room_resolver = RoomResolver()
+
+
+room_changes = CommitTracker(
+    "room_changes", lambda items: room_resolver.invalidate(), lambda session: flushed(session, Room)[:1]
+)
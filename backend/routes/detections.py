@@ -4,16 +4,35 @@
 # Autor: Jaime Varas Cáceres
 # --------------------
 
-import math
+import asyncio
+import csv
+import io
+import json
+import zlib
+from datetime import datetime, timedelta
 
 from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from sqlalchemy import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List
+from typing import List, Literal, Optional
 
-from auth import get_current_user
+from auth import get_current_user, get_current_user_from_request, get_async_db
+from broadcast import temp_detections_hub
+from changes import tombstones_for, sync_cursor, TOMBSTONE_TTL
+from clusters import note_changed as note_clusters_changed
 from database import SessionLocal
-from models import Detection, User, Robot, TempDetection, Room
+from dedup import dedup_engine
+from ingest import ingest_markers, cluster_temp_markers, promote_temp_detections
+from labels import label_index, normalize
+from maintenance import compact_temp_detections, TEMP_DETECTION_TTL
+from models import Detection, User, TempDetection, Room, DetectionTombstone
+from ownership import ownership_cache
+from rooms import room_resolver
+from routes.ros import get_robot_pose
+from spatial import nearest, within_radius
 
 
 def get_db():
@@ -27,6 +46,35 @@ def get_db():
 router = APIRouter(prefix="/detections", tags=["detections"])
 
 
+def _owned_robot(user_dependency):
+    async def require_owned_robot(
+            robot_id: int = Query(..., description="ID of the robot"),
+            db: AsyncSession = Depends(get_async_db),
+            current_user: User = Depends(user_dependency)
+    ) -> int:
+        # Verificar que el robot existe y pertenece al usuario actual
+        if not await ownership_cache.owns(db, current_user.id, robot_id):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="You are not authorized to access this robot's data."
+            )
+        return robot_id
+    return require_owned_robot
+
+
+# Dependencias con el ?robot_id= de un robot del usuario (token en la cabecera
+# o en ?auth=, como en los streams)
+require_owned_robot = _owned_robot(get_current_user)
+require_owned_robot_from_request = _owned_robot(get_current_user_from_request)
+
+# Segundos sin eventos tras los que se manda un comentario al cliente SSE
+SSE_KEEPALIVE = 15
+
+# Filas que se leen de la BD (y se envían) de cada vez en /detections/export
+EXPORT_CHUNK = 1000
+EXPORT_CSV_COLUMNS = ["id", "label", "robot_id", "room_id", "obj_x", "obj_y", "obj_z", "nav_x", "nav_y", "nav_z"]
+
+
 class MarkerPosition(BaseModel):
     x: float
     y: float
@@ -48,146 +96,397 @@ class MarkerList(BaseModel):
     markers: List[MarkerData]
 
 
-def is_close(p1, p2, threshold=1):
-    """Calcula la distancia euclidiana entre dos puntos 3D."""
-    dx = p1["x"] - p2["x"]
-    dy = p1["y"] - p2["y"]
-    return math.sqrt(dx ** 2 + dy ** 2) < threshold
+class PromoteRequest(BaseModel):
+    # Lista de ids o filtro (robot_id obligatorio en ese caso)
+    ids: Optional[List[int]] = None
+    robot_id: Optional[int] = None
+    room_id: Optional[int] = None
+    label: Optional[str] = None
+    min_confidence: Optional[int] = None
+
+
+# Campos que se pueden pedir con ?fields= en GET /detections
+DETECTION_FIELDS = {
+    "id": Detection.id,
+    "label": Detection.label,
+    "position_obj": Detection.position_obj,
+    "position_nav": Detection.position_nav,
+    "robot_id": Detection.robot_id,
+    "room_id": Detection.room_id,
+}
+
+TEMP_DETECTION_FIELDS = {
+    "id": TempDetection.id,
+    "label": TempDetection.label,
+    "position_obj": TempDetection.position_obj,
+    "position_nav": TempDetection.position_nav,
+    "robot_id": TempDetection.robot_id,
+    "room_id": TempDetection.room_id,
+    "confidence": TempDetection.confidence,
+    "hits": TempDetection.hits,
+}
 
 
 @router.get("")
 async def get_detections_for_robot(
-        robot_id: int = Query(..., description="ID of the robot"),
-        db: Session = Depends(get_db),
-        current_user: User = Depends(get_current_user)
+        robot_id: int = Depends(require_owned_robot),
+        limit: Optional[int] = Query(None, ge=1, le=1000, description="Page size (enables pagination)"),
+        cursor: Optional[int] = Query(None, description="next_cursor of the previous page"),
+        fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+        label: Optional[str] = Query(None, description="Only detections with this label"),
+        room_id: Optional[int] = Query(None, description="Only detections in this room"),
+        area: Optional[str] = Query(None, description="Only detections inside x_min,y_min,x_max,y_max"),
+        format: Literal["json", "columnar"] = Query("json", description="columnar: parallel arrays id/label/x/y"),
+        db: AsyncSession = Depends(get_async_db)
 ):
-    # Verificar que el robot existe y pertenece al usuario actual
-    robot = db.query(Robot).filter(Robot.id == robot_id, Robot.owner_id == current_user.id).first()
-    if not robot:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to access this robot's data."
-        )
+    bbox = None
+    if area is not None:
+        try:
+            x_min, y_min, x_max, y_max = (float(v) for v in area.split(","))
+        except ValueError:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="area must be x_min,y_min,x_max,y_max"
+            )
+        bbox = (min(x_min, x_max), min(y_min, y_max), max(x_min, x_max), max(y_min, y_max))
+
+    if format == "columnar":
+        names = ["id", "label", "obj_x", "obj_y"]
+    elif fields:
+        names = [f.strip() for f in fields.split(",") if f.strip()]
+        unknown = set(names) - DETECTION_FIELDS.keys()
+        if unknown:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+            )
+    else:
+        names = list(DETECTION_FIELDS)
+    # El id hace falta para el cursor aunque no se pida
+    columns = [DETECTION_FIELDS.get(n, getattr(Detection, n)) for n in dict.fromkeys(["id", *names])]
+
+    # Obtener detecciones relacionadas con el robot (paginación por id)
+    query = select(*columns).where(Detection.robot_id == robot_id).order_by(Detection.id)
+    if label is not None:
+        query = query.where(Detection.label == label)
+    if room_id is not None:
+        query = query.where(Detection.room_id == room_id)
+    if bbox is not None:
+        query = query.where(Detection.obj_x.between(bbox[0], bbox[2]), Detection.obj_y.between(bbox[1], bbox[3]))
+    if cursor is not None:
+        query = query.where(Detection.id > cursor)
+    if limit is not None:
+        query = query.limit(limit + 1)
+
+    rows = (await db.execute(query)).mappings().all()
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["id"]
+
+    if format == "columnar":
+        return {
+            "ids": [r["id"] for r in rows],
+            "labels": [r["label"] for r in rows],
+            "x": [r["obj_x"] for r in rows],
+            "y": [r["obj_y"] for r in rows],
+            "next_cursor": next_cursor,
+        }
 
-    # Obtener detecciones relacionadas con el robot
-    detections = db.query(Detection).filter(Detection.robot_id == robot_id).all()
-    return detections
+    detections = [{n: r[n] for n in names} for r in rows]
+    if limit is None and cursor is None:
+        return detections  # Respuesta sin paginar, como hasta ahora
+    return {"items": detections, "next_cursor": next_cursor}
 
 
 @router.get("/temp")
 async def get_detections_for_robot(
-        robot_id: int = Query(..., description="ID of the robot"),
-        db: Session = Depends(get_db),
-        current_user: User = Depends(get_current_user)
+        robot_id: int = Depends(require_owned_robot),
+        db: AsyncSession = Depends(get_async_db)
 ):
-    # Verificar que el robot existe y pertenece al usuario actual
-    robot = db.query(Robot).filter(Robot.id == robot_id, Robot.owner_id == current_user.id).first()
-    if not robot:
+    # Obtener detecciones relacionadas con el robot
+    temp_detections = (await db.scalars(select(TempDetection).where(TempDetection.robot_id == robot_id))).all()
+    return temp_detections
+
+
+@router.get("/changes")
+async def get_detection_changes(
+        robot_id: int = Depends(require_owned_robot),
+        since: Optional[datetime] = Query(
+            None, description="cursor of the previous response (responses overlap: apply changes by id); "
+                              "a full list with reset=true is returned if it is older than the kept tombstones"
+        ),
+        db: AsyncSession = Depends(get_async_db)
+):
+    # Se toma antes de consultar y con margen (ver changes.sync_cursor) para
+    # no perder filas cuya transacción se confirma después de esta consulta
+    cursor = sync_cursor()
+    # Con un cursor más antiguo que las lápidas que se guardan faltarían
+    # borrados: se manda todo y el cliente sustituye su copia
+    reset = since is None or since < datetime.utcnow() - TOMBSTONE_TTL
+    if reset:
+        since = None
+    changes = {"cursor": cursor.isoformat(), "reset": reset}
+    for model, fields in ((Detection, DETECTION_FIELDS), (TempDetection, TEMP_DETECTION_FIELDS)):
+        query = select(*fields.values()).where(model.robot_id == robot_id)
+        deleted = []
+        if since is not None:
+            query = query.where(model.updated_at > since)
+            deleted = (await db.scalars(select(DetectionTombstone.detection_id).where(
+                DetectionTombstone.robot_id == robot_id,
+                DetectionTombstone.source_table == model.__tablename__,
+                DetectionTombstone.deleted_at > since
+            ))).all()
+        upserts = (await db.execute(query.order_by(model.id))).mappings().all()
+        changes[model.__tablename__] = {"upserts": [dict(r) for r in upserts], "deleted": deleted}
+
+    return changes
+
+
+async def _query_point(x, y):
+    # Sin punto explícito se usa la posición actual del robot
+    if (x is None) != (y is None):
         raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="You are not authorized to access this robot's data."
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Pass both x and y, or neither to use the robot's pose"
         )
+    if x is not None:
+        return x, y
+    pose = await get_robot_pose()
+    if pose is None:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Robot pose not available; pass x and y"
+        )
+    return pose["x"], pose["y"]
+
+
+def _spatial_filters(robot_id, label, room_id):
+    where = [Detection.robot_id == robot_id]
+    if label is not None:
+        where.append(Detection.label == label)
+    if room_id is not None:
+        where.append(Detection.room_id == room_id)
+    return where
+
+
+@router.get("/nearest")
+async def get_nearest_detections(
+        robot_id: int = Depends(require_owned_robot),
+        x: Optional[float] = Query(None, description="Defaults to the robot's current pose"),
+        y: Optional[float] = Query(None, description="Defaults to the robot's current pose"),
+        k: int = Query(1, ge=1, le=100),
+        label: Optional[str] = Query(None),
+        room_id: Optional[int] = Query(None),
+        db: AsyncSession = Depends(get_async_db)
+):
+    x, y = await _query_point(x, y)
+    return await nearest(
+        db, Detection, DETECTION_FIELDS.values(), x, y, k, *_spatial_filters(robot_id, label, room_id)
+    )
+
+
+@router.get("/within")
+async def get_detections_within(
+        robot_id: int = Depends(require_owned_robot),
+        radius: float = Query(..., gt=0, le=100, description="Radius in meters"),
+        x: Optional[float] = Query(None, description="Defaults to the robot's current pose"),
+        y: Optional[float] = Query(None, description="Defaults to the robot's current pose"),
+        label: Optional[str] = Query(None),
+        room_id: Optional[int] = Query(None),
+        db: AsyncSession = Depends(get_async_db)
+):
+    x, y = await _query_point(x, y)
+    return await within_radius(
+        db, Detection, DETECTION_FIELDS.values(), x, y, radius, *_spatial_filters(robot_id, label, room_id)
+    )
 
-    # Obtener detecciones relacionadas con el robot
-    temp_detections = db.query(TempDetection).filter(TempDetection.robot_id == robot_id).all()
-    return temp_detections
+
+@router.get("/resolve")
+async def resolve_detection_label(
+        robot_id: int = Depends(require_owned_robot),
+        q: str = Query(..., min_length=1, description="Free text, e.g. 'la silla del salón'"),
+        db: AsyncSession = Depends(get_async_db)
+):
+    rooms = {normalize(name): room_id for room_id, name in await db.execute(select(Room.id, Room.name))}
+    return await label_index.resolve(db, robot_id, q, rooms)
+
+
+def export_rows(robot_id, export_format, compress):
+    """
+    Generador con la exportación de las detecciones del robot. Lee con un
+    cursor en el servidor (yield_per), así que la memoria no depende del
+    número de filas. Abre su propia sesión porque se consume después de que
+    el endpoint haya terminado.
+    """
+    gzip = zlib.compressobj(wbits=31) if compress else None
+
+    def encode(text):
+        data = text.encode()
+        return gzip.compress(data) if gzip else data
+
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(*DETECTION_FIELDS.values())
+            .where(Detection.robot_id == robot_id)
+            .order_by(Detection.id)
+            .execution_options(yield_per=EXPORT_CHUNK)
+        ).mappings()
+
+        if export_format == "csv":
+            yield encode(",".join(EXPORT_CSV_COLUMNS) + "\n")
+        for chunk in rows.partitions():
+            buffer = io.StringIO()
+            if export_format == "csv":
+                writer = csv.writer(buffer, lineterminator="\n")
+                for r in chunk:
+                    obj, nav = r["position_obj"] or {}, r["position_nav"] or {}
+                    writer.writerow([
+                        r["id"], r["label"], r["robot_id"], r["room_id"],
+                        obj.get("x"), obj.get("y"), obj.get("z"),
+                        nav.get("x"), nav.get("y"), nav.get("z"),
+                    ])
+            else:
+                for r in chunk:
+                    buffer.write(json.dumps(dict(r)) + "\n")
+            yield encode(buffer.getvalue())
+
+    if gzip:
+        yield gzip.flush()
+
+
+@router.get("/export")
+async def export_detections(
+        robot_id: int = Depends(require_owned_robot),
+        format: Literal["ndjson", "csv"] = Query("ndjson"),
+        gzip: bool = Query(False, description="Compress the export with gzip")
+):
+    filename = f"detections-{robot_id}.{format}" + (".gz" if gzip else "")
+    media_type = "application/gzip" if gzip else ("text/csv" if format == "csv" else "application/x-ndjson")
+    return StreamingResponse(
+        export_rows(robot_id, format, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
 
 
 # POST endpoint to save detections
 @router.post("")
 def save_markers(data: MarkerList, db: Session = Depends(get_db)):
-    added_count = 0
-
-    for marker in data.markers:
-        new_pos = {
-            "x": marker.position_obj.x,
-            "y": marker.position_obj.y,
-            "z": marker.position_obj.z
-        }
-
-        # Buscar detecciones existentes con el mismo label
-        existing_detections = db.query(Detection).filter_by(label=marker.name).all()
-
-        # Verificar si alguna está dentro del umbral de 0.5m
-        duplicate = any(is_close(d.position_obj, new_pos) for d in existing_detections)
-
-        if not duplicate:
-            # Calcular room_id
-            room_id = 0
-            x, y = new_pos["x"], new_pos["y"]
-            rooms = db.query(Room).all()
-            for room in rooms:
-                start = room.position_start
-                end = room.position_end
-
-                if (start["x"] <= x <= end["x"] or end["x"] <= x <= start["x"]) and \
-                        (start["y"] <= y <= end["y"] or end["y"] <= y <= start["y"]):
-                    room_id = room.id
-                    break
-
-            # Guardar detección
-            detection = Detection(
-                label=marker.name,
-                position_obj=new_pos,
-                position_nav=marker.position_nav.__json__(),
-                robot_id=marker.robot_id,
-                room_id=room_id
-            )
-            db.add(detection)
-            added_count += 1
-
+    results = ingest_markers(db, data.markers, Detection, [Detection])
     db.commit()
-    return {"status": "created", "added": added_count}
+    added_count = sum(r["accepted"] for r in results)
+    return {"status": "created", "added": added_count, "results": results}
 
 
 # POST endpoint to save a temporal detection
 @router.post("/temp")
 def save_markers(data: MarkerList, db: Session = Depends(get_db)):
-    added_count = 0
+    results, clusters = cluster_temp_markers(db, data.markers)
+    db.commit()
 
-    for marker in data.markers:
-        new_pos = {
-            "x": marker.position_obj.x,
-            "y": marker.position_obj.y,
-            "z": marker.position_obj.z
-        }
+    for cluster in clusters:
+        temp_detections_hub.publish(cluster["robot_id"], cluster)
+
+    added_count = sum(r["accepted"] for r in results)
+    promoted_count = sum(c["promoted"] for c in clusters)
+    return {"status": "created", "added": added_count, "promoted": promoted_count, "results": results}
 
-        # Buscar detecciones existentes con el mismo label
-        existing_detections_temp = db.query(TempDetection).filter_by(label=marker.name).all()
-        existing_detections = db.query(Detection).filter_by(label=marker.name).all()
-
-        # Verificar si alguna está dentro del umbral de 0.5m
-        duplicate_temp = any(is_close(d.position_obj, new_pos) for d in existing_detections_temp)
-        duplicate = any(is_close(d.position_obj, new_pos) for d in existing_detections)
-
-        if not duplicate_temp and not duplicate:
-            room_id = 0
-            x, y = new_pos["x"], new_pos["y"]
-            print(f"obj: x{x}, y{y}")
-            # Calculate room of the house
-            rooms = db.query(Room).all()
-            for room in rooms:
-                start = room.position_start
-                end = room.position_end
-
-                if (start["x"] <= x <= end["x"] or end["x"] <= x <= start["x"]) and \
-                        (start["y"] <= y <= end["y"] or end["y"] <= y <= start["y"]):
-                    room_id = room.id
-                    break
-
-            detection = TempDetection(
-                label=marker.name,
-                position_obj=new_pos,
-                position_nav=marker.position_nav.__json__(),
-                robot_id=marker.robot_id,
-                confidence=int(marker.confidence),
-                room_id=room_id
-            )
-            db.add(detection)
-            added_count += 1
 
+# GET endpoint (server-sent events) with the temp detections accepted from now on
+@router.get("/temp/stream")
+async def stream_temp_detections(
+        robot_id: int = Depends(require_owned_robot_from_request),
+        db: AsyncSession = Depends(get_async_db)
+):
+    # La conexión no hace falta mientras dure el stream
+    await db.close()
+
+    async def events():
+        async with temp_detections_hub.subscribe(robot_id) as queue:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=SSE_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"event: temp_detection\ndata: {json.dumps(event)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+# POST endpoint to expire and compact the temporal detections on demand
+@router.post("/temp/compact")
+def compact_temp(
+        robot_id: int = Depends(require_owned_robot),
+        max_age_minutes: Optional[float] = Query(
+            None, ge=1, description="Expire this robot's temp detections older than this"
+        ),
+        db: Session = Depends(get_db)
+):
+    max_age = timedelta(minutes=max_age_minutes) if max_age_minutes else TEMP_DETECTION_TTL
+    report = compact_temp_detections(db, max_age, robot_id=robot_id)
     db.commit()
-    return {"status": "created", "added": added_count}
+    return report
+
+
+async def _owned_promote_request(
+        data: PromoteRequest,
+        db: AsyncSession = Depends(get_async_db),
+        current_user: User = Depends(get_current_user)
+) -> PromoteRequest:
+    # Todas las temporales elegidas (por id o por filtro) tienen que ser de robots del usuario
+    selected = set()
+    if data.ids is not None:
+        selected.update(await db.scalars(
+            select(TempDetection.robot_id).where(TempDetection.id.in_(data.ids)).distinct()
+        ))
+    if data.robot_id is not None:
+        selected.add(data.robot_id)
+    if not selected <= (await ownership_cache.robots_of(db, current_user.id)).keys():
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="You are not authorized to access this robot's data."
+        )
+    return data
+
+
+# POST endpoint to persist several temporal detections at once
+@router.post("/save")
+def save_markers(data: PromoteRequest = Depends(_owned_promote_request), db: Session = Depends(get_db)):
+    where = []
+    if data.ids is not None:
+        where.append(TempDetection.id.in_(data.ids))
+    elif data.robot_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Either ids or robot_id must be given"
+        )
+    if data.robot_id is not None:
+        where.append(TempDetection.robot_id == data.robot_id)
+    if data.room_id is not None:
+        where.append(TempDetection.room_id == data.room_id)
+    if data.label is not None:
+        where.append(TempDetection.label == data.label)
+    if data.min_confidence is not None:
+        where.append(TempDetection.confidence >= data.min_confidence)
+
+    try:
+        promoted, conflicts = promote_temp_detections(db, *where)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error saving temporary detections: {str(e)}."
+        )
+
+    return {"status": "created", "promoted": promoted, "conflicts": conflicts}
 
 
 # POST endpoint to persisit temporal detections
@@ -208,11 +507,9 @@ def save_markers(temp_detection_id: int, db: Session = Depends(get_db)):
             "z": 0
         }
 
-        # Buscar detecciones existentes con el mismo label
-        existing_detections = db.query(Detection).filter_by(label=db_temp_detection.label).all()
-
-        # Verificar si alguna está dentro del umbral de 0.5m
-        duplicate = any(is_close(d.position_obj, new_pos) for d in existing_detections)
+        duplicate = dedup_engine.duplicates(
+            db, Detection, db_temp_detection.robot_id, db_temp_detection.label, [(new_pos["x"], new_pos["y"])]
+        )[0]
 
         if duplicate:
             db.rollback()  # Ensure no partial changes are left
@@ -221,12 +518,15 @@ def save_markers(temp_detection_id: int, db: Session = Depends(get_db)):
                 detail="Duplicate object found closer than 0.5m"
             )
 
+        # Las habitaciones pueden haber cambiado desde que se guardó la temporal
+        [room_id] = room_resolver.resolve(db, [(new_pos["x"], new_pos["y"])])
+
         detection = Detection(
             label=db_temp_detection.label,
             position_obj=new_pos,
             position_nav=db_temp_detection.position_nav,
             robot_id=db_temp_detection.robot_id,
-            room_id=db_temp_detection.room_id)
+            room_id=room_id)
         db.add(detection)
         db.delete(db_temp_detection)
         db.commit()
@@ -245,8 +545,8 @@ def save_markers(temp_detection_id: int, db: Session = Depends(get_db)):
 
 
 @router.delete("/{detection_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_detection(detection_id: int, db: Session = Depends(get_db)):
-    db_detection = db.query(Detection).filter(Detection.id == detection_id).first()
+async def delete_detection(detection_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_detection = await db.get(Detection, detection_id)
 
     if not db_detection:
         raise HTTPException(
@@ -255,11 +555,11 @@ async def delete_detection(detection_id: int, db: Session = Depends(get_db)):
         )
 
     try:
-        db.delete(db_detection)
-        db.commit()
+        await db.delete(db_detection)
+        await db.commit()
         return {"status": "200"}
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error deleting detection: {str(e)}"
@@ -267,8 +567,8 @@ async def delete_detection(detection_id: int, db: Session = Depends(get_db)):
 
 
 @router.delete("/temp/{temp_detection_id}", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_temp_detection(temp_detection_id: int, db: Session = Depends(get_db)):
-    db_temp_detection = db.query(TempDetection).filter(TempDetection.id == temp_detection_id).first()
+async def delete_temp_detection(temp_detection_id: int, db: AsyncSession = Depends(get_async_db)):
+    db_temp_detection = await db.get(TempDetection, temp_detection_id)
 
     if not db_temp_detection:
         raise HTTPException(
@@ -277,10 +577,10 @@ async def delete_temp_detection(temp_detection_id: int, db: Session = Depends(ge
         )
 
     try:
-        db.delete(db_temp_detection)
-        db.commit()
+        await db.delete(db_temp_detection)
+        await db.commit()
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error deleting temporary detection: {str(e)}"
@@ -288,14 +588,16 @@ async def delete_temp_detection(temp_detection_id: int, db: Session = Depends(ge
 
 
 @router.delete("/temp/remove/all", status_code=status.HTTP_204_NO_CONTENT)
-async def delete_all_temp_detections(db: Session = Depends(get_db)):
+async def delete_all_temp_detections(db: AsyncSession = Depends(get_async_db)):
     try:
         # Delete all records from TempDetection table
-        db.query(TempDetection).delete()
-        db.commit()
+        await db.execute(tombstones_for(TempDetection))
+        await db.execute(delete(TempDetection))
+        note_clusters_changed(db)
+        await db.commit()
         return {"status": "200"}
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error deleting all temporary detections: {str(e)}"
@@ -304,8 +606,8 @@ async def delete_all_temp_detections(db: Session = Depends(get_db)):
 
 @router.get("/rooms")
 async def get_all_rooms(
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: User = Depends(get_current_user)
 ):
-    all_rooms = db.query(Room).all()
+    all_rooms = (await db.scalars(select(Room))).all()
     return all_rooms
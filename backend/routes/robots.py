@@ -5,47 +5,37 @@
 # --------------------
 
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
-from auth import get_current_user, get_db
-from models import Robot, User
+from auth import get_current_user, get_async_db
+from models import User
+from ownership import ownership_cache
 
 router = APIRouter(prefix="/robots", tags=["robots"])
 
 
 @router.get("", response_model=list[dict])
 async def get_user_robots(
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: User = Depends(get_current_user)  # Ensures the user is authenticated
 ):
-    robots = db.query(Robot).filter(Robot.owner_id == current_user.id).all()
+    robots = await ownership_cache.robots_of(db, current_user.id)
 
     if not robots:
         return []  # Return empty list if no robots found
 
-    return [
-        {
-            "id": robot.id,
-            "name": robot.name,
-            "model": robot.model,
-            "owner_id": robot.owner_id
-        }
-        for robot in robots
-    ]
+    return [dict(robot) for robot in robots.values()]
 
 
 @router.get("/{robot_id}", response_model=dict)
 async def get_robot_by_id(
         robot_id: int,
-        db: Session = Depends(get_db),
+        db: AsyncSession = Depends(get_async_db),
         current_user: User = Depends(get_current_user)  # Ensures the user is authenticated
 ):
-    # Query the robot with the given ID that belongs to the current user
-    robot = db.query(Robot).filter(
-        Robot.id == robot_id,
-        Robot.owner_id == current_user.id
-    ).first()
+    # Look up the robot with the given ID among the ones the current user owns
+    robot = (await ownership_cache.robots_of(db, current_user.id)).get(robot_id)
 
     if not robot:
         raise HTTPException(
@@ -53,9 +43,4 @@ async def get_robot_by_id(
             detail="Robot not found or you don't have permission to access it"
         )
 
-    return {
-        "id": robot.id,
-        "name": robot.name,
-        "model": robot.model,
-        "owner_id": robot.owner_id
-    }
+    return dict(robot)
@@ -6,40 +6,31 @@
 
 import time
 import math
-from typing import Annotated, Dict
+from typing import Annotated, Dict, Optional
+from urllib.parse import urlencode
 
-from fastapi import Depends, APIRouter, HTTPException, status
-from sqlalchemy.orm import Session
+import httpx
+from fastapi import Depends, APIRouter, HTTPException, Query, Request, Response, status
+from sqlalchemy.ext.asyncio import AsyncSession
 from fastapi.responses import StreamingResponse
 
 from models import User, Detection
-from auth import get_current_user, get_current_user_from_request
-from database import SessionLocal
-import requests
-import os
-
-tunnel_url = os.getenv('TUNNEL_URL')
-token = os.getenv('TUNNEL_AUTH_TOKEN')
+from auth import get_current_user, get_current_user_from_request, get_async_db
+from mjpeg import mjpeg_fanout, MEDIA_TYPE as MJPEG_MEDIA_TYPE
+from snapshots import map_snapshots, etag_matches
+from tunnel import tunnel_client
 
 now = time.time()
 secs = int(now)
 nsecs = int((now - secs) * 1e9)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-
-db_dependency = Annotated[Session, Depends(get_db)]
+db_dependency = Annotated[AsyncSession, Depends(get_async_db)]
 
 router = APIRouter(prefix="/ros", tags=["ros"])
 
 
-def publish_goal(position_dict_obj, position_dict_nav):
+async def publish_goal(position_dict_obj, position_dict_nav):
     def yaw_to_quaternion(yaw):
         q = {}
         q['x'] = 0.0
@@ -82,26 +73,33 @@ def publish_goal(position_dict_obj, position_dict_nav):
     }
 
     try:
-        response = requests.post(
-            tunnel_url + "/publish",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
+        response = await tunnel_client().post(
+            "/publish",
             json={
                 'topic': '/move_base_simple/goal',
                 'type': 'geometry_msgs/PoseStamped',
                 'message': message
-            },
-            timeout=5
+            }
         )
         response.raise_for_status()
         print("Goal successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to publish goal: {e}")
         return False
 
 
+async def get_robot_pose():
+    """Posición actual (x, y) del robot según APINexo, o None si no está disponible."""
+    try:
+        response = await tunnel_client().get("/pose")
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPError as e:
+        print(f"Failed to get robot pose: {e}")
+        return None
+
+
 # POST endpoint to navigate to the detection
 @router.post("/{detection_id}/navigate")
 async def navigate_detection(detection_id: int, db: db_dependency, current_user: User = Depends(get_current_user)):
@@ -111,7 +109,7 @@ async def navigate_detection(detection_id: int, db: db_dependency, current_user:
             detail="You don't have permission to do that"
         )
 
-    db_detection = db.query(Detection).filter(Detection.id == detection_id).first()
+    db_detection = await db.get(Detection, detection_id)
 
     if not db_detection:
         raise HTTPException(
@@ -120,7 +118,7 @@ async def navigate_detection(detection_id: int, db: db_dependency, current_user:
         )
 
     try:
-        result = publish_goal(db_detection.position_obj, db_detection.position_nav)
+        result = await publish_goal(db_detection.position_obj, db_detection.position_nav)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Invalid request: {str(e)}")
 
@@ -128,7 +126,7 @@ async def navigate_detection(detection_id: int, db: db_dependency, current_user:
 
 
 @router.post("/navigate")
-def navigate_coords(position: Dict[str, float], current_user: User = Depends(get_current_user)):
+async def navigate_coords(position: Dict[str, float], current_user: User = Depends(get_current_user)):
     if current_user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -136,222 +134,225 @@ def navigate_coords(position: Dict[str, float], current_user: User = Depends(get
         )
 
     try:
-        result = publish_goal(None, position)
+        result = await publish_goal(None, position)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Invalid request: {str(e)}")
 
     return {"message": "Navigation goal published", "position": position, "status": result}
 
 
+async def _mjpeg_stream(path):
+    try:
+        return await mjpeg_fanout.open(path)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Stream not available: {e}")
+
+
 # TODO: Date-time watermarks in images
 @router.get("/proxy-camera")
-def proxy_camera(current_user: User = Depends(get_current_user_from_request)):
+async def proxy_camera(current_user: User = Depends(get_current_user_from_request)):
     if current_user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You don't have permission to do that"
         )
 
-    headers = {
-        'X-Tunnel-Authorization': 'tunnel ' + token
-    }
+    # Una sola conexión al túnel compartida por todos los clientes
+    return StreamingResponse(await _mjpeg_stream("/camera/stream"), media_type=MJPEG_MEDIA_TYPE)
 
-    r = requests.get(f"{tunnel_url}/camera/stream", headers=headers, stream=True)
 
-    return StreamingResponse(r.raw, media_type=r.headers.get("content-type", "image/jpeg"))
+async def _cached_map_image(request: Request, path: str):
+    """Respuesta con ETag de una imagen del mapa pedida al túnel a través de la caché."""
+    try:
+        snapshot = await map_snapshots.get(path)
+    except httpx.HTTPStatusError as e:
+        # 404 de tesela fuera de rango, 400 de zona fuera del mapa...
+        raise HTTPException(status_code=e.response.status_code, detail=e.response.text)
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Map not available: {e}")
+
+    # El cliente revalida con If-None-Match: si no ha cambiado, 304 sin cuerpo
+    headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), snapshot.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(snapshot.body, media_type=snapshot.media_type, headers=headers)
 
 
 @router.get("/proxy-map")
-def proxy_map(current_user: User = Depends(get_current_user_from_request)):
+async def proxy_map(request: Request, current_user: User = Depends(get_current_user_from_request)):
     if current_user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You don't have permission to do that"
         )
 
-    headers = {
-        'X-Tunnel-Authorization': 'tunnel ' + token
-    }
+    return await _cached_map_image(request, "/map/snapshot")
 
-    r = requests.get(f"{tunnel_url}/map/snapshot", headers=headers, stream=True)
 
-    return StreamingResponse(r.raw, media_type=r.headers.get("content-type", "image/jpeg"))
+@router.get("/proxy-map/info")
+async def proxy_map_info(current_user: User = Depends(get_current_user_from_request)):
+    if current_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You don't have permission to do that"
+        )
 
+    try:
+        response = await tunnel_client().get("/map/info")
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Map not available: {e}")
+    return response.json()
 
-@router.get("/proxy-detections")
-def proxy_camera(current_user: User = Depends(get_current_user_from_request)):
+
+@router.get("/proxy-map/tiles/{z}/{x}/{y}")
+async def proxy_map_tile(z: int, x: int, y: int, request: Request,
+                         current_user: User = Depends(get_current_user_from_request)):
     if current_user is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You don't have permission to do that"
         )
 
-    headers = {
-        'X-Tunnel-Authorization': 'tunnel ' + token
-    }
+    return await _cached_map_image(request, f"/map/tiles/{z}/{x}/{y}")
+
+
+@router.get("/proxy-map/view")
+async def proxy_map_view(
+        request: Request,
+        min_x: Optional[float] = None, min_y: Optional[float] = None,
+        max_x: Optional[float] = None, max_y: Optional[float] = None,
+        width: int = Query(600, ge=16, le=2048), height: int = Query(400, ge=16, le=2048),
+        current_user: User = Depends(get_current_user_from_request)
+):
+    if current_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You don't have permission to do that"
+        )
+
+    # La query se rehace con los parámetros validados (sin el token) para
+    # que clientes que piden la misma zona compartan la entrada de la caché
+    params = {"min_x": min_x, "min_y": min_y, "max_x": max_x, "max_y": max_y, "width": width, "height": height}
+    query = urlencode({k: v for k, v in params.items() if v is not None})
+    return await _cached_map_image(request, f"/map/view?{query}")
 
-    r = requests.get(f"{tunnel_url}/detections/stream", headers=headers, stream=True)
 
-    return StreamingResponse(r.raw, media_type=r.headers.get("content-type", "image/jpeg"))
+@router.get("/proxy-detections")
+async def proxy_camera(current_user: User = Depends(get_current_user_from_request)):
+    if current_user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="You don't have permission to do that"
+        )
+
+    # Una sola conexión al túnel compartida por todos los clientes
+    return StreamingResponse(await _mjpeg_stream("/detections/stream"), media_type=MJPEG_MEDIA_TYPE)
 
 
 @router.post("/move-back")
-def move_backwards():
+async def move_backwards():
     try:
-        response = requests.post(
-            tunnel_url + "/move-back",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/move-back")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to move back: {e}")
         return False
 
 
 @router.post("/move-forward")
-def move_forward():
+async def move_forward():
     try:
-        response = requests.post(
-            tunnel_url + "/move-forward",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/move-forward")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to move forward: {e}")
         return False
 
 
 @router.post("/look-left")
-def move_forward():
+async def move_forward():
     try:
-        response = requests.post(
-            tunnel_url + "/move-left",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/move-left")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to look left: {e}")
         return False
 
 
 @router.post("/look-right")
-def move_forward():
+async def move_forward():
     try:
-        response = requests.post(
-            tunnel_url + "/look-right",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/look-right")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to look right: {e}")
         return False
 
 
 @router.post("/look-back")
-def move_forward():
+async def move_forward():
     try:
-        response = requests.post(
-            tunnel_url + "/look-back",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/look-back")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to look back: {e}")
         return False
 
 
 @router.post("/camera/stream/disable")
-def disable_stream_camera():
+async def disable_stream_camera():
     try:
-        response = requests.post(
-            tunnel_url + "/camera/stream/disable",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/camera/stream/disable")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to disable camera stream: {e}")
         return False
 
 
 @router.post("/camera/stream/enable")
-def enable_stream_camera():
+async def enable_stream_camera():
     try:
-        response = requests.post(
-            tunnel_url + "/camera/stream/enable",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/camera/stream/enable")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to enable camera stream: {e}")
         return False
 
 
 @router.post("/patrol/start")
-def start_patrol():
+async def start_patrol():
     try:
-        response = requests.post(
-            tunnel_url + "/start_patrol",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/start_patrol")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to start patrol: {e}")
         return False
 
 
 @router.post("/patrol/stop")
-def stop_patrol():
+async def stop_patrol():
     try:
-        response = requests.post(
-            tunnel_url + "/stop_patrol",
-            headers={
-                'X-Tunnel-Authorization': 'tunnel ' + token
-            },
-            timeout=5
-        )
+        response = await tunnel_client().post("/stop_patrol")
         response.raise_for_status()
         print("Message successfully published via API.")
         return True
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Failed to stop patrol: {e}")
         return False
@@ -0,0 +1,104 @@
+# --------------------
+# Este archivo Python contiene la caché de las imágenes que se piden al
+# túnel (snapshot del mapa), con ETag y una sola petición en vuelo
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import asyncio
+import hashlib
+import os
+import time
+from dataclasses import dataclass
+
+from tunnel import tunnel_client
+
+# Segundos durante los que se sirve la imagen guardada sin preguntar al túnel
+MAP_SNAPSHOT_TTL = float(os.environ.get('MAP_SNAPSHOT_TTL', 2))
+# Rutas guardadas como máximo (teselas y vistas del mapa); se borran las más antiguas
+MAP_SNAPSHOT_CACHE_SIZE = int(os.environ.get('MAP_SNAPSHOT_CACHE_SIZE', 512))
+
+
+@dataclass
+class Snapshot:
+    body: bytes
+    media_type: str
+    etag: str
+    upstream_etag: str
+    expires: float
+
+
+def etag_matches(if_none_match, etag):
+    """Compara la cabecera If-None-Match de un cliente con el ETag actual."""
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+class SnapshotCache:
+    """
+    Guarda la última respuesta de cada ruta durante `ttl` segundos. Las
+    peticiones que llegan mientras se está pidiendo la imagen esperan a esa
+    misma petición en lugar de lanzar otra. Al caducar, si el túnel mandó un
+    ETag se le pregunta con If-None-Match y un 304 renueva la entrada.
+    """
+
+    def __init__(self, ttl=MAP_SNAPSHOT_TTL, max_entries=MAP_SNAPSHOT_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}
+        self._inflight = {}
+        self.hits = self.fetches = self.not_modified = 0
+
+    async def get(self, path):
+        entry = self._entries.get(path)
+        if entry is not None and entry.expires > time.monotonic():
+            self.hits += 1
+            return entry
+
+        task = self._inflight.get(path)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(path, entry))
+            self._inflight[path] = task
+            task.add_done_callback(lambda _: self._inflight.pop(path, None))
+        # shield: si un cliente se va, la petición sigue para los demás
+        return await asyncio.shield(task)
+
+    async def _fetch(self, path, previous):
+        headers = {}
+        if previous is not None and previous.upstream_etag:
+            headers["If-None-Match"] = previous.upstream_etag
+        response = await tunnel_client().get(path, headers=headers)
+        self.fetches += 1
+
+        if response.status_code == 304 and previous is not None:
+            self.not_modified += 1
+            previous.expires = time.monotonic() + self.ttl
+            return previous
+
+        response.raise_for_status()
+        body = response.content
+        etag = '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+        entry = Snapshot(
+            body=body,
+            media_type=response.headers.get("content-type", "image/jpeg"),
+            etag=etag,
+            upstream_etag=response.headers.get("etag", ""),
+            expires=time.monotonic() + self.ttl,
+        )
+        self._entries.pop(path, None)
+        self._entries[path] = entry
+        while len(self._entries) > self.max_entries:
+            del self._entries[next(iter(self._entries))]
+        return entry
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "fetches": self.fetches,
+            "not_modified": self.not_modified,
+            "entries": len(self._entries),
+        }
+
+
+map_snapshots = SnapshotCache()
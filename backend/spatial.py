@@ -0,0 +1,81 @@
+# --------------------
+# Este archivo Python contiene el índice espacial por celdas
+# que se usa para buscar detecciones cercanas
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import math
+
+from sqlalchemy import select
+
+# Distancia (m) por debajo de la cual dos detecciones con el mismo label
+# se consideran el mismo objeto
+DEDUP_RADIUS = 1.0
+
+# Tamaño de celda de la rejilla. Con celdas del mismo tamaño que el radio,
+# cualquier vecino está en el bloque 3x3 alrededor de la celda del punto
+CELL_SIZE = DEDUP_RADIUS
+
+# Ventana máxima (en celdas) de la búsqueda de vecinos antes de leerlo todo
+KNN_MAX_REACH = 256
+
+
+def is_close(p1, p2, threshold=DEDUP_RADIUS):
+    """Calcula la distancia euclidiana entre dos puntos 3D."""
+    dx = p1["x"] - p2["x"]
+    dy = p1["y"] - p2["y"]
+    return math.sqrt(dx ** 2 + dy ** 2) < threshold
+
+
+def cell_of(x, y):
+    """Devuelve la celda (cell_x, cell_y) de la rejilla que contiene el punto."""
+    return math.floor(x / CELL_SIZE), math.floor(y / CELL_SIZE)
+
+
+def cell_window(model, x, y, radius=DEDUP_RADIUS):
+    """Condiciones SQL que limitan la búsqueda a las celdas que cubren el radio."""
+    cx, cy = cell_of(x, y)
+    reach = math.ceil(radius / CELL_SIZE)
+    return (
+        model.cell_x.between(cx - reach, cx + reach),
+        model.cell_y.between(cy - reach, cy + reach),
+    )
+
+
+def _with_distance(rows, x, y):
+    return sorted(
+        ({**r, "distance": math.hypot(r["position_obj"]["x"] - x, r["position_obj"]["y"] - y)} for r in rows),
+        key=lambda r: r["distance"]
+    )
+
+
+async def within_radius(db, model, columns, x, y, radius, *where):
+    """Filas de `model` a menos de `radius` de (x, y), de la más cercana a la más lejana."""
+    rows = (await db.execute(
+        select(*columns).where(
+            *where, *cell_window(model, x, y, radius),
+            model.obj_x.between(x - radius, x + radius), model.obj_y.between(y - radius, y + radius)
+        )
+    )).mappings().all()
+    return [r for r in _with_distance(rows, x, y) if r["distance"] <= radius]
+
+
+async def nearest(db, model, columns, x, y, k, *where):
+    """
+    Las `k` filas de `model` más cercanas a (x, y). Busca en ventanas de
+    celdas cada vez más grandes: con una ventana de `reach` celdas alrededor
+    del punto, todo lo que esté a menos de reach * CELL_SIZE ya está dentro.
+    """
+    reach = 1
+    while reach <= KNN_MAX_REACH:
+        rows = (await db.execute(
+            select(*columns).where(*where, *cell_window(model, x, y, reach * CELL_SIZE))
+        )).mappings().all()
+        found = _with_distance(rows, x, y)
+        if len(found) >= k and found[k - 1]["distance"] <= reach * CELL_SIZE:
+            return found[:k]
+        reach *= 2
+
+    # Quedan pocos o están muy lejos: sin ventana
+    rows = (await db.execute(select(*columns).where(*where))).mappings().all()
+    return _with_distance(rows, x, y)[:k]
@@ -0,0 +1,59 @@
+# --------------------
+# Este archivo Python contiene el cliente HTTP compartido para las
+# llamadas al túnel de APINexo (conexiones persistentes y reutilizadas)
+# Autor: Jaime Varas Cáceres
+# --------------------
+
+import asyncio
+import os
+
+import httpx
+
+tunnel_url = os.getenv('TUNNEL_URL')
+token = os.getenv('TUNNEL_AUTH_TOKEN')
+
+# Tiempos máximos (s) de las llamadas al túnel
+TUNNEL_CONNECT_TIMEOUT = float(os.environ.get('TUNNEL_CONNECT_TIMEOUT', 5))
+TUNNEL_READ_TIMEOUT = float(os.environ.get('TUNNEL_READ_TIMEOUT', 5))
+# Conexiones abiertas como máximo y cuánto se mantiene una conexión ociosa
+TUNNEL_MAX_CONNECTIONS = int(os.environ.get('TUNNEL_MAX_CONNECTIONS', 20))
+TUNNEL_KEEPALIVE_EXPIRY = float(os.environ.get('TUNNEL_KEEPALIVE_EXPIRY', 60))
+
+# Los streams (MJPEG) pueden estar un rato sin datos: sin límite de lectura
+STREAM_TIMEOUT = httpx.Timeout(TUNNEL_READ_TIMEOUT, connect=TUNNEL_CONNECT_TIMEOUT, read=None)
+
+_client = None
+_client_loop = None
+
+
+def tunnel_client():
+    """Cliente único del event loop; se crea en la primera llamada."""
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client_loop = loop
+        _client = httpx.AsyncClient(
+            base_url=tunnel_url or "",
+            headers={'X-Tunnel-Authorization': 'tunnel ' + token} if token else {},
+            timeout=httpx.Timeout(TUNNEL_READ_TIMEOUT, connect=TUNNEL_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=TUNNEL_MAX_CONNECTIONS,
+                max_keepalive_connections=TUNNEL_MAX_CONNECTIONS,
+                keepalive_expiry=TUNNEL_KEEPALIVE_EXPIRY
+            ),
+        )
+    return _client
+
+
+async def close_tunnel_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def open_stream(path):
+    """Abre un GET en streaming al túnel; hay que cerrar la respuesta (aclose)."""
+    client = tunnel_client()
+    request = client.build_request("GET", path, timeout=STREAM_TIMEOUT)
+    return await client.send(request, stream=True)
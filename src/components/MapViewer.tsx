@@ -18,6 +18,7 @@ function MapViewer({ interactiveMap = true }: MapViewerProps) {
   const [autoRefresh, setAutoRefresh] = useState(false);
   const [mapUrl, setMapUrl] = useState<string>("https://placehold.co/600x400?text=Cargando+mapa...");
   const imgRef = useRef<HTMLImageElement>(null);
+  const etagRef = useRef<string | null>(null);
 
   // CONFIG — ajustar al mapa
   const mapWidth = 600;
@@ -31,8 +32,21 @@ function MapViewer({ interactiveMap = true }: MapViewerProps) {
     if (!token) return;
 
     const baseUrl = process.env.NEXT_PUBLIC_API_BASE_URL || 'http://localhost:8000';
-    const mapUrl = `${baseUrl}/ros/proxy-map?auth=${localStorage.getItem('token')}&reload=${reload}`;
-    setMapUrl(mapUrl);
+    // Petición condicional: si el mapa no ha cambiado el backend responde 304 y se mantiene la imagen
+    fetch(`${baseUrl}/ros/proxy-map?auth=${token}`, {
+      headers: etagRef.current ? { 'If-None-Match': etagRef.current } : {},
+      cache: 'no-store',
+    })
+      .then(async (res) => {
+        if (res.status !== 200) return;
+        etagRef.current = res.headers.get('ETag');
+        const url = URL.createObjectURL(await res.blob());
+        setMapUrl(prev => {
+          if (prev.startsWith('blob:')) URL.revokeObjectURL(prev);
+          return url;
+        });
+      })
+      .catch(() => {});
     }, [reload]);
 
   useEffect(() => {